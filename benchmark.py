@@ -0,0 +1,496 @@
+"""
+Micro-benchmarks of the hot paths of the middleware. They don't need a running server or Redis.
+
+    python benchmark.py framing --recipients 5000 --size 1000
+    python benchmark.py compression --recipients 5000 --size 4000
+    python benchmark.py soak --rounds 20 --connections 10000
+    python benchmark.py subtree --channels 100000 --depth 3
+    python benchmark.py brokers --messages 100000 [--redis-url redis://127.0.0.1:6379/0]
+    python benchmark.py routing --channels 100000 --messages 1000000
+    python benchmark.py filtering --recipients 10000 --messages 100
+    python benchmark.py heartbeats --connections 10000 --duration 2
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import string
+import StringIO
+import sys
+import tempfile
+import time
+
+import gevent
+import gevent.event
+from geventwebsocket.websocket import Header, WebSocket
+
+import websocket_channels
+
+
+class NullStream(object):
+    """Stream of a websocket which discards written data.
+    """
+    def write(self, data):
+        pass
+
+    def read(self, size):
+        return ''
+
+
+class NullConnection(object):
+    """Connection of a websocket which discards the frames sent to it.
+    """
+    frame_type = 0
+    prefix = False
+
+    def __init__(self, channel, attributes):
+        self.channel = channel
+        self.attributes = attributes
+
+    def send_frame(self, frame):
+        return True
+
+
+class PongStream(object):
+    """Stream of a websocket whose client sends nothing but answers pings, with empty pongs
+    (browsers do so), unless it's dead.
+    """
+    PONG_FRAME = Header.encode_header(True, WebSocket.OPCODE_PONG, '', 0, 0)
+
+    def __init__(self, alive=True):
+        self.alive = alive
+        self.received = ''
+
+    def write(self, data):
+        if self.alive and data == websocket_channels.Heartbeats.PING_FRAME:
+            self.received += self.PONG_FRAME
+
+    def read(self, size):
+        data, self.received = self.received[:size], self.received[size:]
+        return data
+
+
+class Handler(object):
+    """Handler of a websocket, where `TimedWebSocket` records when frames are received.
+    """
+
+
+def measure(func, *args):
+    """Call the function and return the CPU time it took, in seconds.
+    """
+    started_at = time.clock()
+    func(*args)
+    return time.clock() - started_at
+
+
+def get_memory_usage():
+    """Return the resident set size of the process, in MB.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() / 1024.0 / 1024
+    except IOError:  # not Linux, take the peak usage
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def count_channels(channel_sockets):
+    """Return the number of nodes in a ChannelSockets tree.
+    """
+    count = 0
+    channels = [channel_sockets]
+    while channels:
+        channel_sockets = channels.pop()
+        count += 1
+        channels.extend(channel_sockets)
+    return count
+
+
+def print_cost(title, cpu_time, count):
+    print "{:<40} {:10.3f} usec. per recipient".format(title, cpu_time * 1000000 / count)
+
+
+def benchmark_framing(args):
+    """Compare framing a message for every recipient with framing it once per fan-out.
+    """
+    message = 'x' * args.size
+    websockets = [WebSocket({}, NullStream(), None) for _ in xrange(args.recipients)]
+
+    def send_each():
+        for websocket in websockets:
+            websocket.send(message)
+
+    def send_encoded_once():
+        frame = websocket_channels.encode_frame(message)
+        for websocket in websockets:
+            websocket.raw_write(frame)
+
+    print "Broadcasting a {} bytes message to {} websockets:".format(
+        args.size, args.recipients)
+    print_cost('websocket.send() for each recipient', measure(send_each), args.recipients)
+    print_cost('encode_frame() once', measure(send_encoded_once), args.recipients)
+
+    try:
+        from ws4py.messaging import TextMessage
+    except ImportError:
+        return
+    print_cost('ws4py: TextMessage.single() for each',
+               measure(lambda: [TextMessage(message).single() for _ in websockets]),
+               args.recipients)
+    print_cost('ws4py: TextMessage.single() once',
+               measure(lambda: [TextMessage(message).single()] * len(websockets)),
+               args.recipients)
+
+
+def benchmark_compression(args):
+    """Compare the bandwidth and CPU cost of broadcasting a JSON message uncompressed, compressed
+    for each recipient and compressed once per fan-out (permessage-deflate without context
+    takeover).
+    """
+    rand = random.Random(0)  # the same message in every run
+    words = [''.join(rand.choice(string.ascii_lowercase) for _ in xrange(rand.randint(1, 9)))
+             for _ in xrange(1000)]
+    text = ' '.join(rand.choice(words) for _ in xrange(args.size // 6))
+    message = json.dumps({'channel': 'chat/room', 'user': 'someone', 'text': text})
+    websockets = [WebSocket({}, NullStream(), None) for _ in xrange(args.recipients)]
+
+    def send_uncompressed():
+        frame = websocket_channels.encode_frame(message)
+        for websocket in websockets:
+            websocket.raw_write(frame)
+
+    def send_compressed_each():
+        for websocket in websockets:
+            websocket.raw_write(websocket_channels.encode_frame(message, deflate=True))
+
+    def send_compressed_once():
+        frame = websocket_channels.encode_frame(message, deflate=True)
+        for websocket in websockets:
+            websocket.raw_write(frame)
+
+    frame_size = len(websocket_channels.encode_frame(message))
+    deflate_frame = websocket_channels.encode_frame(message, deflate=True)
+    print "Broadcasting a {} bytes JSON message to {} websockets:".format(
+        len(message), args.recipients)
+    print "{:<40} {:10d} bytes per recipient".format('Frame, uncompressed', frame_size)
+    print "{:<40} {:10d} bytes per recipient ({:.0%})".format(
+        'Frame, compressed', len(deflate_frame), float(len(deflate_frame)) / frame_size)
+    print_cost('Uncompressed', measure(send_uncompressed), args.recipients)
+    print_cost('Compressed for each recipient', measure(send_compressed_each), args.recipients)
+    print_cost('Compressed once per fan-out', measure(send_compressed_once), args.recipients)
+
+    # receiving the same messages from clients; frames are not masked, to measure only inflating
+    receiving = [(WebSocket, websocket_channels.encode_frame(message), 'Receiving uncompressed'),
+                 (websocket_channels.DeflateWebSocket, deflate_frame, 'Receiving compressed')]
+    for websocket_class, frame, title in receiving:
+        websocket = websocket_class({}, StringIO.StringIO(frame * args.recipients), None)
+        print "{:<40} {:10.3f} usec. per message".format(title, measure(
+            lambda: [websocket.read_message() for _ in websockets]) * 1000000 / args.recipients)
+
+
+def benchmark_soak(args):
+    """Register and unregister websockets on ever new channels, checking that the memory used
+    by the channel tree stays flat.
+    """
+    channel_sockets = websocket_channels.ChannelSockets('')
+    print "{:>6} {:>10} {:>10}".format('Round', 'Channels', 'RSS, MB')
+    for round_no in xrange(args.rounds):
+        registered = []
+        for connection_no in xrange(args.connections):
+            node = channel_sockets
+            for channel in ('room', str(round_no), str(connection_no)):
+                node = node[channel]
+            connection = object()
+            node.add(connection)
+            registered.append((node, connection))
+        for node, connection in registered:
+            node.discard(connection)
+        del registered
+        print "{:>6} {:>10} {:>10.1f}".format(
+            round_no, count_channels(channel_sockets), get_memory_usage())
+
+
+def benchmark_subtree(args):
+    """Compare broadcasting to a subtree through the index of the websockets registered under
+    a channel with walking the subtree recursively; show the cost of maintaining the index.
+    """
+    channel_sockets = websocket_channels.ChannelSockets('')
+    nodes = []
+    for channel_no in xrange(args.channels):
+        node = channel_sockets['users']
+        for _ in xrange(args.depth - 1):
+            node = node[str(channel_no % 10)]
+        nodes.append(node[str(channel_no)])
+    connections = [object() for _ in nodes]
+
+    def register():
+        for node, connection in zip(nodes, connections):
+            node.add(connection)
+
+    def unregister():
+        for node, connection in zip(nodes, connections):
+            node.discard(connection)
+
+    def walk(channel_sockets):
+        count = 0
+        for channel_sockets in channel_sockets:
+            count += len(channel_sockets.websockets) + walk(channel_sockets)
+        return count
+
+    def iterate_index():
+        return sum(1 for _ in channel_sockets['users'].descendant_websockets)
+
+    print "{} channels `users/.../<id>`, {} levels deep:".format(args.channels, args.depth)
+    print "{:<40} {:10.3f} usec. per websocket".format(
+        'Registering', measure(register) * 1000000 / args.channels)
+    print_cost('Broadcast to `users/`, recursive walk',
+               measure(walk, channel_sockets['users']), args.channels)
+    print_cost('Broadcast to `users/`, index', measure(iterate_index), args.channels)
+    print "{:<40} {:10.3f} usec. per websocket".format(
+        'Unregistering', measure(unregister) * 1000000 / args.channels)
+
+
+def benchmark_brokers(args):
+    """Compare how fast messages published through each broker are delivered on one machine.
+    """
+    socket_dir = tempfile.mkdtemp()
+    brokers = [
+        ('in-process', websocket_channels.InProcessBroker()),
+        ('unix socket', websocket_channels.UnixSocketBroker(socket_dir)),
+        ('in-process, 4 shards', websocket_channels.ShardedBroker(
+            {str(shard_no): websocket_channels.InProcessBroker() for shard_no in xrange(4)})),
+    ]
+    if args.redis_url:
+        brokers.append(('redis', websocket_channels.RedisBroker(args.redis_url)))
+        brokers.append(('redis, one subscriber per host', websocket_channels.HostRedisBroker(
+            args.redis_url, socket_dir=socket_dir + '/redis')))
+    if args.shard_urls:
+        brokers.append(('redis, {} shards'.format(len(args.shard_urls)),
+                        websocket_channels.ShardedRedisBroker(args.shard_urls)))
+    message = 'x' * args.size
+    print "Publishing {} messages of {} bytes:".format(args.messages, args.size)
+    try:
+        for title, broker in brokers:
+            received = []
+            all_received = gevent.event.Event()
+
+            def deliver(messages):
+                received.extend(messages)
+                if len(received) >= args.messages:
+                    all_received.set()
+
+            broker.start(deliver)
+            broker.subscribe(['benchmark'])
+            gevent.sleep(0.1)  # let the broker subscribe
+            started_at = time.time()
+            for _ in xrange(args.messages):
+                broker.publish(message, 'benchmark')
+            all_received.wait(timeout=60)
+            duration = time.time() - started_at
+            broker.unsubscribe(['benchmark'])
+            broker.close()
+            print "{:<40} {:10.0f} messages/sec. ({} delivered)".format(
+                title, len(received) / duration, len(received))
+    finally:
+        shutil.rmtree(socket_dir)
+
+
+def benchmark_routing(args):
+    """Compare finding the channel of every delivered message by splitting its name and
+    descending the channel tree with the cache of nodes by channel name, in both servers.
+    """
+    middleware = websocket_channels.WebSocketChannelMiddleware(
+        None, broker=websocket_channels.InProcessBroker())
+    channels = ['rooms/{}/{}'.format(channel_no % 100, channel_no)
+                for channel_no in xrange(args.channels)]
+    for channel in channels:
+        node = middleware.channel_sockets
+        for name in channel.split('/'):
+            node = node[name]
+        node.add(object())
+    rand = random.Random(0)
+    hot_channels = channels[:args.hot]  # most messages go to a few busy channels
+    messages = [rand.choice(hot_channels) if rand.random() < 0.9 else rand.choice(channels)
+                for _ in xrange(args.messages)]
+
+    def split_and_descend(find):
+        for channel in messages:
+            find(name for name in channel.split('/') if name)
+
+    def cached(find):
+        for channel in messages:
+            find(channel)
+
+    print "{} messages to {} channels, 90% to {} of them:".format(
+        args.messages, args.channels, args.hot)
+    print "{:<40} {:10.3f} usec. per message".format(
+        'Split and descend the tree', measure(
+            split_and_descend, middleware.channel_sockets.find) * 1000000 / args.messages)
+    print "{:<40} {:10.3f} usec. per message".format(
+        'Cache of nodes by channel', measure(
+            cached, middleware._find_channel_sockets) * 1000000 / args.messages)
+
+    try:
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ws4py'))
+        import echo_gevent_server
+    except ImportError:
+        return
+    app = echo_gevent_server.application
+
+    def descend(channel):
+        channel_sockets = app.channel_sockets
+        for name in channel.split('/'):
+            if name:
+                channel_sockets = channel_sockets[name]
+        return channel_sockets
+
+    environ = {'PATH_INFO': '/ws/rooms/1/1', 'REQUEST_METHOD': 'GET', 'SERVER_NAME': 'localhost',
+               'SERVER_PORT': '9000', 'wsgi.url_scheme': 'http'}
+    print "ws4py:"
+    print "{:<40} {:10.3f} usec. per message".format(
+        'Split and descend the tree', measure(
+            lambda: [descend(channel) for channel in messages]) * 1000000 / args.messages)
+    print "{:<40} {:10.3f} usec. per message".format(
+        'Cache of nodes by channel', measure(
+            lambda: [app.get_channel_sockets(channel) for channel in messages]) *
+        1000000 / args.messages)
+    print "{:<40} {:10.3f} usec. per request".format(
+        'Websocket request, URL map', measure(
+            lambda: [app.url_map.bind_to_environ(environ).match() for _ in xrange(10000)]) * 100)
+    print "{:<40} {:10.3f} usec. per request".format(
+        'Websocket request, fast path', measure(
+            lambda: [environ['PATH_INFO'].startswith('/ws/') and environ['PATH_INFO'][4:]
+                     for _ in xrange(10000)]) * 100)
+
+
+def benchmark_filtering(args):
+    """Compare broadcasting JSON messages to all the websockets of a channel with selecting the
+    recipients by a filter of the message pipeline, and with a filter decoding the message for
+    each recipient.
+    """
+    muted = {'user-{}'.format(user_no) for user_no in xrange(0, args.recipients, 10)}
+    messages = [json.dumps({'from': 'user-{}'.format(message_no), 'text': 'x' * 100})
+                for message_no in xrange(args.messages)]
+
+    def mute(channel, message):  # recipients muting the sender don't get its messages
+        sender = json.loads(message)['from']
+        return lambda attributes: sender not in attributes['muted']
+
+    def mute_each(channel, message):
+        return lambda attributes: json.loads(message)['from'] not in attributes['muted']
+
+    def broadcast(pipeline):
+        middleware = websocket_channels.WebSocketChannelMiddleware(
+            None, broker=websocket_channels.InProcessBroker(), pipeline=pipeline,
+            metrics=websocket_channels.Metrics(enabled=False))
+        for user_no in xrange(args.recipients):
+            middleware._register_websocket(NullConnection(
+                'room', {'muted': muted if user_no % 2 else ()}), 'room')
+        return measure(lambda: [middleware._send_message('room', message)
+                                for message in messages])
+
+    print "Broadcasting {} messages to {} websockets, half of them muting 10% of senders:".format(
+        args.messages, args.recipients)
+    recipients = args.messages * args.recipients
+    print_cost('No pipeline', broadcast(None), recipients)
+    for title, message_filter in [('Filter, decoded once per message', mute),
+                                  ('Filter, decoded for each recipient', mute_each)]:
+        pipeline = websocket_channels.MessagePipeline()
+        pipeline.add_filter('room', message_filter)
+        print_cost(title, broadcast(pipeline), recipients)
+
+
+def benchmark_heartbeats(args):
+    """Measure the cost of the timer wheel of the heartbeats, and check that silent clients
+    answering pings stay connected while dead ones are disconnected.
+    """
+    heartbeats = websocket_channels.Heartbeats(args.interval, args.interval, args.interval / 10)
+    advance = heartbeats.wheel.advance
+    tick_times = []
+    heartbeats.wheel.advance = lambda: tick_times.append(measure(advance))
+    connections = []
+    for number in xrange(args.connections):
+        websocket_class = (websocket_channels.DeflateWebSocket if number % 2 else
+                           websocket_channels.TimedWebSocket)
+        stream = PongStream(alive=number % 4 < 2)
+        connection = websocket_channels.WebSocketConnection(
+            websocket_class({}, stream, Handler()), 'room')
+        connections.append((stream, connection))
+        heartbeats.add(connection)
+    heartbeats.start()
+    stop_at = time.time() + args.duration
+    while time.time() < stop_at:
+        gevent.sleep(heartbeats.wheel.tick)
+        for stream, connection in connections:
+            while stream.received:  # read the pongs, as the middleware would
+                connection.websocket.read_frame()
+    heartbeats.close()
+
+    alive = [connection for stream, connection in connections if stream.alive]
+    dead = [connection for stream, connection in connections if not stream.alive]
+    print "{:<40} {:10.3f} usec. per connection".format(
+        'Slowest tick', max(tick_times) * 1000000 / args.connections)
+    for title, group in [('Answering clients disconnected', alive),
+                         ('Dead clients disconnected', dead)]:
+        print "{:<40} {:10d} of {}".format(
+            title, sum(connection.closed for connection in group), len(group))
+    if any(connection.closed for connection in alive):
+        sys.exit('Clients answering pings were disconnected')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='WebSocket Channels micro-benchmarks')
+    subparsers = parser.add_subparsers()
+
+    framing_parser = subparsers.add_parser('framing', help=benchmark_framing.__doc__)
+    framing_parser.add_argument('--recipients', default=5000, type=int)
+    framing_parser.add_argument('--size', default=1000, type=int, help='message size in bytes')
+    framing_parser.set_defaults(func=benchmark_framing)
+
+    compression_parser = subparsers.add_parser('compression', help=benchmark_compression.__doc__)
+    compression_parser.add_argument('--recipients', default=5000, type=int)
+    compression_parser.add_argument('--size', default=4000, type=int,
+                                    help='approximate message size in bytes')
+    compression_parser.set_defaults(func=benchmark_compression)
+
+    soak_parser = subparsers.add_parser('soak', help=benchmark_soak.__doc__)
+    soak_parser.add_argument('--rounds', default=20, type=int)
+    soak_parser.add_argument('--connections', default=10000, type=int,
+                             help='websockets registered in each round, each on a new channel')
+    soak_parser.set_defaults(func=benchmark_soak)
+
+    subtree_parser = subparsers.add_parser('subtree', help=benchmark_subtree.__doc__)
+    subtree_parser.add_argument('--channels', default=100000, type=int)
+    subtree_parser.add_argument('--depth', default=3, type=int)
+    subtree_parser.set_defaults(func=benchmark_subtree)
+
+    brokers_parser = subparsers.add_parser('brokers', help=benchmark_brokers.__doc__)
+    brokers_parser.add_argument('--messages', default=100000, type=int)
+    brokers_parser.add_argument('--size', default=100, type=int, help='message size in bytes')
+    brokers_parser.add_argument('--redis-url', help='benchmark also Redis on this URL')
+    brokers_parser.add_argument('--shard-url', action='append', dest='shard_urls',
+                                help='benchmark also Redis sharded over these URLs (repeated)')
+    brokers_parser.set_defaults(func=benchmark_brokers)
+
+    routing_parser = subparsers.add_parser('routing', help=benchmark_routing.__doc__)
+    routing_parser.add_argument('--channels', default=100000, type=int)
+    routing_parser.add_argument('--hot', default=100, type=int, help='number of busy channels')
+    routing_parser.add_argument('--messages', default=1000000, type=int)
+    routing_parser.set_defaults(func=benchmark_routing)
+
+    filtering_parser = subparsers.add_parser('filtering', help=benchmark_filtering.__doc__)
+    filtering_parser.add_argument('--recipients', default=10000, type=int)
+    filtering_parser.add_argument('--messages', default=100, type=int)
+    filtering_parser.set_defaults(func=benchmark_filtering)
+
+    heartbeats_parser = subparsers.add_parser('heartbeats', help=benchmark_heartbeats.__doc__)
+    heartbeats_parser.add_argument('--connections', default=10000, type=int)
+    heartbeats_parser.add_argument('--interval', default=0.5, type=float,
+                                   help='seconds before pinging and waiting for the pong')
+    heartbeats_parser.add_argument('--duration', default=2, type=float, help='seconds')
+    heartbeats_parser.set_defaults(func=benchmark_heartbeats)
+
+    args = parser.parse_args()
+    args.func(args)
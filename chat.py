@@ -4,6 +4,7 @@ A chat server using WebSockets.
     gunicorn chat:websockets --config=gunicorn_settings.py
 """
 import json
+import re
 
 import flask
 
@@ -11,9 +12,10 @@ import websocket_channels
 
 
 REDIS_URL = 'redis://127.0.0.1:6379/0'
+CHUNK_SIZE = 65536  # how much of a request body is read at once
 
 app = flask.Flask(__name__)
-websockets = websocket_channels.WebSocketChannelMiddleware(app, REDIS_URL)
+websockets = websocket_channels.WebSocketChannelMiddleware(app, REDIS_URL, stats_path='/ws-stats')
 
 
 @app.route('/')
@@ -26,12 +28,103 @@ def channel_view(channel):
     return flask.render_template('channel.html', channel=channel.rstrip('/'))
 
 
+json_decoder = json.JSONDecoder()
+whitespace_re = re.compile(r'\s*')
+
+
+def iter_json_object_items(stream):
+    """Parse a JSON object read from the stream, yielding its (key, value) pairs as soon as they
+    are read, so a large object is never kept in memory as a whole.
+
+    Raises:
+        ValueError: if the data is not a JSON object
+    """
+    buffer = ''
+    position = 0
+    expected = '{'  # what comes next: `{`, `key or }`, `key`, `:`, `value` or `, or }`
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        buffer = buffer[position:] + chunk
+        position = 0
+        while True:
+            position = whitespace_re.match(buffer, position).end()
+            if position == len(buffer):
+                break
+            char = buffer[position]
+            if expected in ('{', ':'):
+                if char != expected:
+                    raise ValueError('Expected `%s` at `%s`' % (expected, buffer[position:][:20]))
+                position += 1
+                expected = 'key or }' if expected == '{' else 'value'
+            elif expected == ', or }':
+                if char not in ',}':
+                    raise ValueError('Expected `,` or `}` at `%s`' % buffer[position:][:20])
+                if char == '}':
+                    return
+                position += 1
+                expected = 'key'
+            elif expected == 'key or }' and char == '}':
+                return
+            else:  # a key or a value, which may be incomplete yet
+                try:
+                    item, end = json_decoder.raw_decode(buffer, position)
+                except ValueError:
+                    if not chunk:
+                        raise
+                    break
+                if chunk and (end == len(buffer) or buffer[end] in '.eE'):
+                    break  # a number may continue in the next chunk
+                position = end
+                if expected == 'value':
+                    yield key, item
+                    expected = ', or }'
+                elif isinstance(item, basestring):
+                    key = item
+                    expected = ':'
+                else:
+                    raise ValueError('Expected a key, got %r' % item)
+        if not chunk:
+            raise ValueError('Unexpected end of JSON data')
+
+
+def iter_ndjson_items(stream):
+    """Yield (key, value) pairs of JSON objects read from the stream, one per line.
+    """
+    for line in iter(stream.readline, ''):
+        if line.strip():
+            for item in json.loads(line).iteritems():
+                yield item
+
+
 @app.route('/publish', methods=('POST',))
 def publish_messages_view():
     """Publish given messages on the given channels. The POST body should be in form of
-    {channel: message, ...}
+    {channel: message, ...} or, with the `application/x-ndjson` content type, such objects one per
+    line. The body is parsed as it's read and published in batches, so it may be large. Messages
+    read before an invalid part of the body are published.
+    """
+    stream = flask.request.stream
+    if flask.request.mimetype == 'application/x-ndjson':
+        messages = iter_ndjson_items(stream)
+    else:
+        messages = iter_json_object_items(stream)
+    try:
+        websockets.publish_many(messages)
+    except ValueError as exc:  # invalid JSON or a reserved channel
+        return flask.Response('Invalid messages: %s' % exc, status=400)
+    return flask.Response('OK')
+
+
+@app.route('/publish/<path:channel>', methods=('POST',))
+def publish_message_view(channel):
+    """Publish the POST body as is on the given channel, in binary frames if its content type is
+    `application/octet-stream`.
     """
-    data = json.loads(flask.request.get_data())
-    for channel, message in data.iteritems():
+    message = flask.request.get_data()
+    if flask.request.mimetype == 'application/octet-stream':
+        message = memoryview(message)
+    try:
         websockets.publish_message(message, channel)
+    except ValueError as exc:  # a reserved channel
+        return flask.Response('Invalid channel: %s' % exc, status=400)
     return flask.Response('OK')
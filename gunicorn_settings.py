@@ -6,5 +6,6 @@ workers = 1  # number of worker process for handling requests
 worker_connections = 1000  # maximum number of simultaneous clients
 logconfig = 'logging.conf'
 timeout = 30
+graceful_timeout = 30  # websockets are closed over the first half of it when a worker stops
 # add current directory to python path, because gunicorn doesn't do this
 pythonpath = '.'
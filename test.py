@@ -1,113 +1,266 @@
+"""
+Load generator and latency benchmark for WebSocket channels.
+
+Subscribers connect to channels over websockets, publishers send timestamped messages at a given
+rate for a given time, and the end-to-end latency of every delivered message is recorded.
+The results are printed as JSON, so runs can be compared.
+
+    # 100 channels, each with 50 subscribers and a publisher sending 10 messages/sec.
+    python test.py --channels 100 --subscribers 50 --publishers 1 --rate 10 --duration 30
+
+    # each client alone on its channel, receiving back the 100 messages/sec. it sends
+    python test.py --channels 2000 --subscribers 0 --publishers 1 --rate 100 --duration 1
+
+    # publish over HTTP to `bench/`, so subscribers of all the channels `bench/<n>` receive it
+    python test.py --topology subtree --channels 100 --subscribers 10
+
+    # publish in binary frames instead of text ones
+    python test.py --binary
+
+    # run the server in this process, with an in-process broker or a local Redis
+    python test.py --in-process [--redis-url redis://127.0.0.1:6379/0]
+"""
 from gevent import monkey; monkey.patch_all()
 
 import argparse
+import collections
+import json
 import time
+import urllib2
+
 import gevent
+import gevent.event
 from ws4py.client import WebSocketBaseClient
 from ws4py import configure_logger
 
 
 logger = configure_logger(level='WARNING')
 
-stats = {}
-# TODO: check that other clients from the same channel received the message
+SERVER_ADDRESS = '127.0.0.1:9000'
 
 
-class WebSocketClient(WebSocketBaseClient):
+class Results(object):
+    """Measurements collected during a run.
+    """
+    def __init__(self):
+        self.handshake_times = []
+        self.latencies = []
+        self.published_count = 0
+        self.expected_count = 0  # number of deliveries of the published messages
+        self.errors = collections.Counter()
 
-    def __init__(self, client_id, url, *args, **kwargs):
-        self.client_id = client_id
-        self.stats = stats.setdefault(self.client_id, {})
-        self.errors = self.stats.setdefault('errors', {})
-        self.message_count = 0
-        super(WebSocketClient, self).__init__(url, *args, **kwargs)
 
-    def get_new_message(self):
-        self.message_count += 1
-        return 'Message #{:<3} from client #{:<5}'.format(self.message_count, self.client_id)
+class WebSocketClient(WebSocketBaseClient):
+    """Client on a channel, recording the latency of every received message.
+    """
+    def __init__(self, url, results):
+        self.results = results
+        self.connecting_at = None
+        self.opened_event = gevent.event.Event()
+        super(WebSocketClient, self).__init__(url)
 
     def connect(self):
-        self.stats['handshake_started_at'] = time.time()
+        self.connecting_at = time.time()
         return super(WebSocketClient, self).connect()
 
     def handshake_ok(self):
-        self.stats['handshake_done_at'] = time.time()
-        # logger.info("Opened #%s %s", self.client_id, format_addresses(self))
-        # time.sleep(random.random() * 1)
-        self.stats['message_sent_at'] = time.time()
-        self.send(self.get_new_message())
-        self.stats['message_sent_at2'] = time.time()
+        self.results.handshake_times.append(time.time() - self.connecting_at)
+        self.opened_event.set()
+
+    def received_message(self, message):
+        received_at = time.time()
+        try:
+            self.results.latencies.append(received_at - json.loads(str(message))['sent'])
+        except (ValueError, KeyError):
+            self.results.errors['unexpected message'] += 1
+
+
+def run_client(client):
+    """Connect the client and process the received messages until it is closed.
+    """
+    try:
+        client.connect()
+    except Exception as exc:
+        client.results.errors[exc.__class__.__name__] += 1
+        client.opened_event.set()  # don't wait for it
+        return
+    client.run()
+
+
+def run_publisher(publish, channel, recipient_count, publisher_id, args, results):
+    """Publish messages on the channel at the given rate for the given time.
+    """
+    interval = 1.0 / args.rate
+    padding = 'x' * args.size
+    finish_at = time.time() + args.duration
+    publish_at = time.time()
+    message_no = 0
+    while publish_at < finish_at:
+        message_no += 1
+        message = json.dumps({'id': '{}-{}'.format(publisher_id, message_no),
+                              'sent': time.time(), 'padding': padding})
+        try:
+            publish(channel, message)
+        except Exception as exc:
+            results.errors[exc.__class__.__name__] += 1
+        else:
+            results.published_count += 1
+            results.expected_count += recipient_count
+        publish_at += interval
+        gevent.sleep(max(0, publish_at - time.time()))
+
+
+def start_server(args):
+    """Start the middleware in this process.
+
+    Returns:
+        tuple: the middleware and the address of the server
+    """
+    from gevent.pywsgi import WSGIServer
+    import websocket_channels
+
+    def not_found_app(environ, start_response):
+        start_response('404 Not Found', [('Content-Type', 'text/plain')])
+        return ['Not Found']
 
-    def received_message(self, msg):
-        self.stats['echo_message_received_at'] = time.time()
-        self.close()
+    if args.redis_url:
+        broker = websocket_channels.RedisBroker(args.redis_url)
+    else:
+        broker = websocket_channels.InProcessBroker()
+    middleware = websocket_channels.WebSocketChannelMiddleware(not_found_app, broker=broker)
+    server = WSGIServer(('127.0.0.1', 0), middleware,
+                        handler_class=websocket_channels.Worker.wsgi_handler)
+    server.start()
+    return middleware, '127.0.0.1:{}'.format(server.server_port)
 
 
 def calculate_stats(array):
-    """Return min, max, avg in the given array.
+    """Return min, max, avg and percentiles of the given array, multiplied by 1000 (to convert
+    seconds to milliseconds).
     """
-    _count = 0
-    _max = _sum = 0.0
-    _min = None
-    for number in array:
-        _count += 1
-        if _min is None or number < _min:
-            _min = number
-        if number > _max:
-            _max = number
-        _sum += number
-    return {'min': _min, 'max': _max, 'avg': _sum / _count}
-        
-
-CLIENT_COUNT = 2000
-WS_CHANNEL_URL = 'ws://127.0.0.1:9000/ws/client/{client_id}'
+    array = sorted(array)
+    if not array:
+        return {}
 
-if __name__ == '__main__':
+    def percentile(percent):
+        return array[min(len(array) - 1, int(len(array) * percent / 100.0))] * 1000
 
-    parser = argparse.ArgumentParser(description='WebSocket Channels test')
-    parser.add_argument('--clients', default=CLIENT_COUNT, type=int)
-    # parser.add_argument('-p', '--port', default=5000, type=int)
-    args = parser.parse_args()
+    return {
+        'min': array[0] * 1000, 'max': array[-1] * 1000, 'avg': sum(array) * 1000 / len(array),
+        'p50': percentile(50), 'p99': percentile(99), 'p999': percentile(99.9),
+    }
 
-    threads = []
 
-    for i in xrange(args.clients):
+def main(args):
+    results = Results()
+    if args.in_process:
+        middleware, address = start_server(args)
 
-        def run_client(client_id):
-            client = WebSocketClient(client_id, WS_CHANNEL_URL.format(client_id=client_id))
-            client.connect()
-            client.run()
+        def publish_http(channel, message):
+            middleware.publish_message(bytearray(message) if args.binary else message, channel)
+    else:
+        address = args.address
 
-        threads.append(gevent.Greenlet(run_client, i))
+        def publish_http(channel, message):
+            if args.binary:
+                request = urllib2.Request('http://{}/publish/{}'.format(address, channel), message,
+                                          {'Content-Type': 'application/octet-stream'})
+            else:
+                request = urllib2.Request('http://{}/publish'.format(address),
+                                          json.dumps({channel: message}))
+            urllib2.urlopen(request).read()
 
-    print "%d clients were created\n" % (i + 1)
+    def publish_websocket(client):
+        def publish(channel, message):
+            client.send(message, binary=args.binary)
+        return publish
 
-    start_time = time.time()
+    ws_url = 'ws://{}/ws/bench/{{}}'.format(address)
+    clients = []
+    publishers = []  # (publish function, channel, recipient count)
+    for channel_no in xrange(args.channels):
+        if args.topology == 'subtree':
+            for subscriber_no in xrange(args.subscribers):
+                clients.append(WebSocketClient(
+                    ws_url.format('{}/{}'.format(channel_no, subscriber_no)), results))
+        else:
+            channel_clients = [WebSocketClient(ws_url.format(channel_no), results)
+                               for _ in xrange(args.subscribers + args.publishers)]
+            clients.extend(channel_clients)
+            for client in channel_clients[args.subscribers:]:
+                publishers.append((publish_websocket(client), None, len(channel_clients)))
+    if args.topology == 'subtree':
+        publishers = [(publish_http, 'bench/', args.channels * args.subscribers)
+                      for _ in xrange(args.publishers)]
 
-    for thread in threads:
-        thread.start()
+    started_at = time.time()
+    client_threads = [gevent.spawn(run_client, client) for client in clients]
+    for client in clients:
+        client.opened_event.wait()
+    connected_in = time.time() - started_at
 
-    gevent.joinall(threads)
+    started_at = time.time()
+    gevent.joinall([gevent.spawn(run_publisher, publish, channel, recipient_count,
+                                 publisher_id, args, results)
+                    for publisher_id, (publish, channel, recipient_count)
+                    in enumerate(publishers)])
+    published_in = time.time() - started_at
+    gevent.sleep(args.wait)  # let the last messages arrive
+    for client in clients:
+        if not client.terminated:
+            client.close()
+    gevent.joinall(client_threads, timeout=5)
 
-    print "Clients finished in {:.2f} sec.\n".format(time.time() - start_time)
+    delivered_count = len(results.latencies)
+    return {
+        'config': vars(args),
+        'clients': len(clients),
+        'connected_in': connected_in,
+        'handshake_ms': calculate_stats(results.handshake_times),
+        'published': results.published_count,
+        'expected_deliveries': results.expected_count,
+        'delivered': delivered_count,
+        'completeness': (float(delivered_count) / results.expected_count
+                         if results.expected_count else None),
+        'messages_per_sec': {
+            'published': results.published_count / published_in,
+            'delivered': delivered_count / (published_in + args.wait),
+        },
+        'latency_ms': calculate_stats(results.latencies),
+        'errors': dict(results.errors),
+    }
 
-    print """Handshake times (msec):
-  Average: {avg:10.2f}    Min: {min:10.2f}    Max: {max:10.2f}
-""".format(**calculate_stats(
-        (_stats['handshake_done_at'] - _stats['handshake_started_at']) * 1000
-        for _stats in stats.itervalues()))
 
-    print """Echo response times (msec):
-  Average: {avg:10.2f}    Min: {min:10.2f}    Max: {max:10.2f}
-""".format(**calculate_stats(
-        (_stats['echo_message_received_at'] - _stats['message_sent_at']) * 1000
-        for _stats in stats.itervalues()))
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='WebSocket Channels load test')
+    parser.add_argument('--address', default=SERVER_ADDRESS,
+                        help='host:port of the server, unless --in-process')
+    parser.add_argument('--in-process', action='store_true',
+                        help='run the server in this process instead of connecting to one')
+    parser.add_argument('--redis-url', help='with --in-process, use Redis on this URL as the '
+                                            'broker instead of delivering in-process')
+    parser.add_argument('--topology', choices=('channel', 'subtree'), default='channel',
+                        help='channel: publishers send over websockets to their own channel; '
+                             'subtree: publishers send over HTTP to all the channels at once')
+    parser.add_argument('--channels', default=100, type=int)
+    parser.add_argument('--subscribers', default=10, type=int, help='subscribers per channel')
+    parser.add_argument('--publishers', default=1, type=int,
+                        help='publishers per channel, or in total for the subtree topology')
+    parser.add_argument('--rate', default=1.0, type=float,
+                        help='messages per second sent by each publisher')
+    parser.add_argument('--duration', default=10.0, type=float, help='seconds to publish for')
+    parser.add_argument('--size', default=100, type=int, help='padding added to each message')
+    parser.add_argument('--binary', action='store_true',
+                        help='publish the messages as binary instead of text')
+    parser.add_argument('--wait', default=2.0, type=float,
+                        help='seconds to wait for the messages after publishing has finished')
+    parser.add_argument('--output', help='file to write the results to, instead of stdout')
+    args = parser.parse_args()
 
-    errors = {}
-    for _stats in stats.itervalues():
-        for error_code, error_count in _stats['errors'].iteritems():
-            errors[error_code] = errors.get(error_code, 0) + error_count
-    if errors:
-        print "Errors:"
-        for error_code, error_count in errors.iteritems():
-            print "  {}: {}".format(error_code, error_count)
+    results = json.dumps(main(args), indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(results)
+    else:
+        print results
@@ -2,24 +2,119 @@
 Based on Flask-Sockets (https://github.com/kennethreitz/flask-sockets) and
 https://devcenter.heroku.com/articles/python-websockets
 """
+import bisect
+import collections
+import errno
+import fcntl
 import functools
+import glob
+import hashlib
+import itertools
+import json
 import logging
+import math
+import os
+import random
+import re
+import socket
+import struct
+import time
+import urlparse
+import zlib
 
 import redis
 import gevent
+import gevent.event
+import gevent.lock
+import gevent.queue
+import gevent.socket
+import geventwebsocket.exceptions
 import geventwebsocket.gunicorn.workers
+import geventwebsocket.handler
+import geventwebsocket.websocket
+
+try:
+    import msgpack
+except ImportError:  # optional, see the `envelope` option of `WebSocketChannelMiddleware`
+    msgpack = None
 
 
 logger = logging.getLogger(__name__)
 logger.setLevel('WARNING')
 
 
+class WebSocketHandler(geventwebsocket.handler.WebSocketHandler):
+    """Lets the application reject a websocket before the handshake, with a plain HTTP response,
+    if it has an `admit_websocket` method (see `WebSocketChannelMiddleware.admit_websocket`).
+
+    Negotiates the permessage-deflate extension if the client offers it and the application's
+    `accept_deflate` method allows it; the websocket is then a `DeflateWebSocket`, otherwise a
+    `TimedWebSocket`.
+    """
+    DEFLATE_KEY = 'websocket_channels.deflate'  # environ key set when the extension is accepted
+
+    def upgrade_websocket(self):
+        admit_websocket = getattr(self.application, 'admit_websocket', None)
+        if (admit_websocket is None or self.environ.get('REQUEST_METHOD') != 'GET'
+                or self.environ.get('HTTP_UPGRADE', '').lower() != 'websocket'):
+            result = super(WebSocketHandler, self).upgrade_websocket()
+            if hasattr(self, 'websocket'):
+                self.websocket.__class__ = TimedWebSocket
+            return result
+        rejection = admit_websocket(self.environ)
+        if rejection is not None:
+            status, headers, body = rejection
+            self.close_connection = True  # don't keep the rejected clients around
+            self.start_response(status, headers + [('Content-Length', str(len(body)))])
+            return [body]
+        accept_deflate = getattr(self.application, 'accept_deflate', None)
+        if (accept_deflate is not None
+                and is_deflate_offered(self.environ.get('HTTP_SEC_WEBSOCKET_EXTENSIONS', ''))
+                and accept_deflate(self.environ)):
+            self.environ[self.DEFLATE_KEY] = True
+        result = super(WebSocketHandler, self).upgrade_websocket()
+        if not hasattr(self, 'websocket'):  # the handshake failed
+            self.application.release_websocket(self.environ)
+        elif self.environ.get(self.DEFLATE_KEY):
+            self.websocket.__class__ = DeflateWebSocket
+        else:
+            self.websocket.__class__ = TimedWebSocket
+        return result
+
+    def start_response(self, status, headers, exc_info=None):
+        if status.startswith('101') and self.environ.get(self.DEFLATE_KEY):
+            headers = headers + [('Sec-WebSocket-Extensions', DEFLATE_RESPONSE)]
+        return super(WebSocketHandler, self).start_response(status, headers, exc_info)
+
+
 class Worker(geventwebsocket.gunicorn.workers.GeventWebSocketWorker):
-    """The worker used here.
+    """The worker used here. Handshakes of websockets are checked by the admission control of
+    the application before they are accepted, and the maximum number of websockets is derived
+    from `worker_connections`, unless it is set explicitly.
+
+    When the worker is stopped gracefully (on SIGTERM, sent also on reload), the application's
+    websockets are drained (see `WebSocketChannelMiddleware.drain`) within `graceful_timeout`
+    instead of being dropped when it expires.
     """
-    # TODO: It would be nice to hook on WebSocket connection handshake to be able to reject
-    # TODO: undesired connections
-    # TODO: https://github.com/abourget/gevent-socketio/blob/master/socketio/sgunicorn.py
+    wsgi_handler = WebSocketHandler
+    # share of `worker_connections` kept for plain HTTP requests and rejected handshakes
+    reserved_connections_ratio = 0.1
+    # share of `graceful_timeout` over which the websockets are closed, the rest is for flushing
+    drain_window_ratio = 0.5
+
+    def handle_exit(self, sig, frame):
+        drain = getattr(self.wsgi, 'drain', None)
+        if drain is not None and self.alive:
+            gevent.spawn(drain, self.cfg.graceful_timeout * self.drain_window_ratio)
+        super(Worker, self).handle_exit(sig, frame)
+
+    def run(self):
+        admission = getattr(self.wsgi, 'admission', None)
+        if admission is not None and admission.max_connections is None:
+            admission.max_connections = max(
+                1, self.worker_connections - int(self.worker_connections *
+                                                 self.reserved_connections_ratio))
+        super(Worker, self).run()
 
 
 def async(func):
@@ -29,72 +124,2830 @@ def async(func):
     def wrapper(*args, **kwargs):
         return gevent.spawn(func, *args, **kwargs)
 
-    return wrapper
+    return wrapper
+
+
+class LatencyHistogram(object):
+    """Histogram of latencies (in seconds) with fixed exponential buckets, cheap enough to be
+    updated for every message.
+    """
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is for +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, percent):
+        """Return the upper bound of the bucket containing the given percentile or None if
+        nothing was observed yet.
+        """
+        if not self.count:
+            return None
+        rank = self.count * percent / 100.0
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+
+
+def encode_frame(message, binary=False, deflate=False):
+    """Build a complete unmasked WebSocket frame carrying the given message. Frames sent by a
+    server don't depend on the recipient, so one frame can be written to any number of websockets.
+
+    Args:
+        message (str|unicode|bytearray|memoryview): the payload; unicode is encoded to UTF-8
+        binary (bool): whether to send a binary frame instead of a text one
+        deflate (bool): whether to compress the message for websockets which negotiated
+            permessage-deflate; it is compressed without context takeover, so the frame still
+            doesn't depend on the recipient
+
+    Returns:
+        str|bytearray: the frame; a bytearray if the payload is neither str nor unicode, so it
+            is copied only once
+    """
+    if isinstance(message, unicode):
+        message = message.encode('utf-8')
+    WebSocket = geventwebsocket.websocket.WebSocket
+    Header = geventwebsocket.websocket.Header
+    opcode = WebSocket.OPCODE_BINARY if binary else WebSocket.OPCODE_TEXT
+    flags = 0
+    if deflate:
+        if isinstance(message, memoryview):
+            message = message.tobytes()
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        # the empty block appended by the sync flush is removed (RFC 7692, 7.2.1)
+        message = (compressor.compress(message) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+        flags = Header.RSV0_MASK  # RSV1 of the RFC
+    header = Header.encode_header(True, opcode, '', len(message), flags)
+    if isinstance(message, str):
+        return header + message
+    frame = bytearray(header)
+    frame += message
+    return frame
+
+
+BINARY_TYPES = (bytearray, memoryview, buffer)  # types of binary messages
+BINARY_PREFIX = '\xff'  # never starts UTF-8 text, marks binary messages between the workers
+
+
+def encode_binary_message(message):
+    """Return a binary message (see `BINARY_TYPES`) as published through the broker: prefixed
+    with `BINARY_PREFIX`, so the workers send it in binary frames.
+    """
+    if isinstance(message, memoryview):
+        return BINARY_PREFIX + message.tobytes()
+    return BINARY_PREFIX + str(message)
+
+
+def decode_binary_message(message):
+    """Return the payload of a binary message received through the broker, without copying
+    it, or None if the message is text.
+    """
+    if type(message) is str and message[:1] == BINARY_PREFIX:
+        return memoryview(message)[1:]
+    return None
+
+
+DEFLATE_RESPONSE = 'permessage-deflate; server_no_context_takeover; client_no_context_takeover'
+
+
+def is_deflate_offered(extensions):
+    """Return whether the permessage-deflate extension is offered in the given value of the
+    `Sec-WebSocket-Extensions` header with parameters allowing to compress messages with the
+    default window size, without context takeover.
+    """
+    for offer in extensions.split(','):
+        params = [param.strip() for param in offer.split(';')]
+        if params[0].lower() != 'permessage-deflate':
+            continue
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            name = name.strip().lower()
+            value = value.strip().strip('"')
+            if name == 'server_max_window_bits' and value != str(zlib.MAX_WBITS):
+                break  # the shared frames are compressed with the maximum window
+            if name not in ('server_max_window_bits', 'client_max_window_bits',
+                            'server_no_context_takeover', 'client_no_context_takeover'):
+                break
+        else:
+            return True
+    return False
+
+
+class TimedWebSocket(geventwebsocket.websocket.WebSocket):
+    """WebSocket recording when the last frame, pongs included, was received from the client,
+    for `Heartbeats`. It is recorded in the handler, as a `WebSocket` has no room for attributes,
+    so nothing is recorded for a websocket without one, e.g. in the benchmarks.
+    """
+    __slots__ = ()  # the class of a `WebSocket` is replaced after the handshake
+
+    def read_frame(self):
+        frame = super(TimedWebSocket, self).read_frame()
+        self._record_frame_received()
+        return frame
+
+    def _record_frame_received(self):
+        if self.handler is not None:
+            self.handler.frame_received_at = time.time()
+
+
+class DeflateWebSocket(TimedWebSocket):
+    """WebSocket which negotiated permessage-deflate without context takeover (RFC 7692):
+    received messages may be compressed, each one on its own. Messages sent using `send` are
+    not compressed, use `encode_frame` for that.
+    """
+    __slots__ = ()  # the class of a `WebSocket` is replaced after the handshake
+
+    MAX_MESSAGE_SIZE = 16 * 1024 * 1024  # maximum size of an inflated message
+
+    def read_frame(self):
+        """Same as `WebSocket.read_frame`, except that the compression flag is allowed.
+        """
+        Header = geventwebsocket.websocket.Header
+        header = Header.decode_header(self.stream)
+        if header.flags & ~Header.RSV0_MASK:
+            raise geventwebsocket.exceptions.ProtocolError
+        if not header.length:  # e.g. a pong
+            self._record_frame_received()
+            return header, ''
+        try:
+            payload = self.raw_read(header.length)
+        except Exception:
+            payload = ''
+        if len(payload) != header.length:
+            raise geventwebsocket.WebSocketError('Unexpected EOF reading frame payload')
+        if header.mask:
+            payload = header.unmask_payload(payload)
+        self._record_frame_received()
+        return header, payload
+
+    def read_message(self):
+        """Same as `WebSocket.read_message`, except that compressed messages are inflated.
+        """
+        opcode = None
+        compressed = False
+        fragments = []
+        while True:
+            header, payload = self.read_frame()
+            if header.opcode in (self.OPCODE_TEXT, self.OPCODE_BINARY):
+                if opcode:
+                    raise geventwebsocket.exceptions.ProtocolError(
+                        'The opcode in non-fin frame is expected to be zero, got %r' %
+                        header.opcode)
+                opcode = header.opcode
+                compressed = bool(header.flags)
+            elif header.opcode == self.OPCODE_CONTINUATION:
+                if not opcode or header.flags:
+                    raise geventwebsocket.exceptions.ProtocolError(
+                        'Unexpected frame with opcode=0')
+            elif header.flags:  # control frames are never compressed
+                raise geventwebsocket.exceptions.ProtocolError
+            elif header.opcode == self.OPCODE_PING:
+                self.handle_ping(header, payload)
+                continue
+            elif header.opcode == self.OPCODE_PONG:
+                self.handle_pong(header, payload)
+                continue
+            elif header.opcode == self.OPCODE_CLOSE:
+                self.handle_close(header, payload)
+                return
+            else:
+                raise geventwebsocket.exceptions.ProtocolError(
+                    'Unexpected opcode=%r' % header.opcode)
+            fragments.append(payload)
+            if header.fin:
+                break
+
+        message = ''.join(fragments)
+        if compressed:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            try:
+                message = decompressor.decompress(message + '\x00\x00\xff\xff',
+                                                  self.MAX_MESSAGE_SIZE)
+            except zlib.error:
+                raise geventwebsocket.exceptions.ProtocolError('Invalid compressed message')
+            if decompressor.unconsumed_tail:
+                raise geventwebsocket.exceptions.ProtocolError('Inflated message is too large')
+        if opcode == self.OPCODE_TEXT:
+            self.utf8validator.reset()
+            self.validate_utf8(message)
+            return message
+        return bytearray(message)
+
+
+class TokenBucket(object):
+    """Token bucket rate limiter: allows `rate` events per second on average and bursts of up to
+    `burst` events.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(self.rate, 1)
+        self.tokens = self.burst
+        self.updated_at = time.time()
+
+    def consume(self, tokens=1):
+        """Take tokens from the bucket. The bucket may go into debt, which is paid off by the
+        following refills.
+
+        Returns:
+            float: number of seconds to wait before the event may happen; 0 if it may happen now
+        """
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        self.tokens -= tokens
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+
+class TimerWheel(object):
+    """Hashed timer wheel: timers are kept in `slot_count` buckets of `tick` seconds, and one
+    greenlet fires the timers of the current bucket every tick, so any number of timers costs
+    one wakeup per tick instead of one each. Timers further than a turn of the wheel wait for
+    their number of turns. They fire up to `tick` seconds late.
+    """
+    def __init__(self, callback, tick=1.0, slot_count=512):
+        """
+        Args:
+            callback (callable): called with the item of each timer when it fires
+            tick (float): seconds between the buckets, the precision of the timers
+            slot_count (int): number of buckets, timers are best kept within one turn
+        """
+        self.callback = callback
+        self.tick = tick
+        self._slots = [{} for _ in xrange(slot_count)]  # item -> remaining turns
+        self._item_slots = {}  # item -> its bucket
+        self._position = 0
+        self._ticker = None
+
+    def __len__(self):
+        return len(self._item_slots)
+
+    def start(self):
+        if self._ticker is None:
+            self._ticker = self._run()
+
+    def schedule(self, item, delay):
+        """Call back with the item in `delay` seconds, replacing its timer if it has one.
+        """
+        self.cancel(item)
+        ticks = max(1, int(math.ceil(delay / self.tick)))
+        slot = self._slots[(self._position + ticks) % len(self._slots)]
+        slot[item] = (ticks - 1) // len(self._slots)
+        self._item_slots[item] = slot
+
+    def cancel(self, item):
+        slot = self._item_slots.pop(item, None)
+        if slot is not None:
+            del slot[item]
+
+    def advance(self):
+        """Move to the next bucket and fire its timers which are due.
+        """
+        self._position = (self._position + 1) % len(self._slots)
+        slot = self._slots[self._position]
+        due = []
+        for item, turns in slot.iteritems():
+            if turns:
+                slot[item] = turns - 1
+            else:
+                due.append(item)
+        for item in due:
+            del slot[item]
+            del self._item_slots[item]
+        for item in due:
+            try:
+                self.callback(item)
+            except Exception:
+                logger.exception('Failed to fire a timer')
+
+    @async
+    def _run(self):
+        next_tick_at = time.time() + self.tick
+        while True:
+            gevent.sleep(max(0, next_tick_at - time.time()))
+            next_tick_at += self.tick
+            self.advance()
+
+    def close(self):
+        if self._ticker is not None:
+            self._ticker.kill()
+            self._ticker = None
+
+
+def format_sample_name(name, labels):
+    """Return the name of a Prometheus sample with the given labels, e.g. `name{label="value"}`.
+    Backslashes, double quotes and line feeds in the values are escaped, as channels in labels
+    come from the clients.
+    """
+    if not labels:
+        return name
+    return '%s{%s}' % (name, ','.join(
+        '%s="%s"' % (label, unicode(value).replace('\\', '\\\\').replace('"', '\\"')
+                     .replace('\n', '\\n'))
+        for label, value in sorted(labels.iteritems())))
+
+
+class Metrics(object):
+    """Counters, gauges and histograms, exported in the Prometheus text format. Recording costs
+    almost nothing when the metrics are disabled.
+
+    Workers of one host can share their metrics through a directory, where each of them
+    periodically saves a snapshot, so any worker can export the sum of all of them. Gauges are
+    set by `collect` before each snapshot is saved and before the metrics are exported.
+    """
+    def __init__(self, enabled=True, shared_dir=None, share_interval=5):
+        """
+        Args:
+            enabled (bool): whether to record anything
+            shared_dir (str): directory where workers save their snapshots
+            share_interval (float): how often to save the snapshot, in seconds
+        """
+        self.enabled = enabled
+        self.shared_dir = shared_dir
+        self.share_interval = share_interval
+        self.counters = collections.Counter()
+        self.gauges = {}
+        self.histograms = {}
+        self.collect = None  # called to set the gauges, e.g. by the middleware
+        if enabled and shared_dir:
+            if not os.path.isdir(shared_dir):
+                os.makedirs(shared_dir)
+            self._share()
+
+    def increment(self, name, value=1):
+        if self.enabled:
+            self.counters[name] += value
+
+    def observe(self, name, value):
+        """Add a value to a histogram.
+        """
+        if not self.enabled:
+            return
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = LatencyHistogram()
+        histogram.observe(value)
+
+    def set_gauge(self, name, value, **labels):
+        if self.enabled:
+            self.gauges[format_sample_name(name, labels)] = value
+
+    def _collect(self):
+        """Set the gauges by calling `collect`.
+        """
+        if self.collect is not None:
+            try:
+                self.collect()
+            except Exception:
+                logger.exception('Failed to collect the gauges')
+
+    def snapshot(self):
+        """Return the current values as a JSON serializable dict.
+        """
+        return {
+            'counters': dict(self.counters),
+            'gauges': self.gauges.copy(),
+            'histograms': dict(
+                (name, {'buckets': histogram.buckets, 'counts': histogram.counts,
+                        'sum': histogram.sum, 'count': histogram.count})
+                for name, histogram in self.histograms.iteritems()),
+        }
+
+    @async
+    def _share(self):
+        """Periodically save the snapshot of this worker for other workers.
+        """
+        path = os.path.join(self.shared_dir, '%d.json' % os.getpid())
+        while True:
+            gevent.sleep(self.share_interval)
+            self._collect()
+            with open(path + '.tmp', 'w') as snapshot_file:
+                json.dump(self.snapshot(), snapshot_file)
+            os.rename(path + '.tmp', path)  # atomically
+
+    def _get_shared_snapshots(self):
+        """Return recent snapshots of the other workers.
+        """
+        own_path = os.path.join(self.shared_dir, '%d.json' % os.getpid())
+        min_mtime = time.time() - self.share_interval * 3  # older are left by dead workers
+        snapshots = []
+        for path in glob.glob(os.path.join(self.shared_dir, '*.json')):
+            try:
+                if path == own_path or os.path.getmtime(path) < min_mtime:
+                    continue
+                with open(path) as snapshot_file:
+                    snapshots.append(json.load(snapshot_file))
+            except (OSError, IOError, ValueError):  # removed or being written
+                continue
+        return snapshots
+
+    def export(self):
+        """Return the metrics in the Prometheus text format, summed up with the metrics shared by
+        the other workers.
+        """
+        self._collect()
+        total = self.snapshot()
+        if self.shared_dir:
+            for snapshot in self._get_shared_snapshots():
+                for kind in ('counters', 'gauges'):
+                    for name, value in snapshot[kind].iteritems():
+                        total[kind][name] = total[kind].get(name, 0) + value
+                for name, histogram in snapshot['histograms'].iteritems():
+                    total_histogram = total['histograms'].get(name)
+                    if total_histogram is None:
+                        total['histograms'][name] = histogram
+                    elif list(total_histogram['buckets']) == list(histogram['buckets']):
+                        total_histogram['counts'] = [
+                            count + other_count for count, other_count
+                            in zip(total_histogram['counts'], histogram['counts'])]
+                        total_histogram['sum'] += histogram['sum']
+                        total_histogram['count'] += histogram['count']
+
+        lines = []
+        typed_names = set()
+        for kind, metric_type in (('counters', 'counter'), ('gauges', 'gauge')):
+            for name, value in sorted(total[kind].iteritems()):
+                base_name = name.split('{', 1)[0]
+                if base_name not in typed_names:
+                    typed_names.add(base_name)
+                    lines.append('# TYPE %s %s' % (base_name, metric_type))
+                lines.append('%s %s' % (name, value))
+        for name, histogram in sorted(total['histograms'].iteritems()):
+            lines.append('# TYPE %s histogram' % name)
+            cumulative_count = 0
+            for bound, count in zip(list(histogram['buckets']) + ['+Inf'], histogram['counts']):
+                cumulative_count += count
+                lines.append('%s_bucket{le="%s"} %d' % (name, bound, cumulative_count))
+            lines.append('%s_sum %s' % (name, histogram['sum']))
+            lines.append('%s_count %d' % (name, histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+
+class RedisPublisher(object):
+    """PUBLISHes messages to Redis in batches. Messages are put into a bounded queue and a single
+    greenlet sends them using a non-transactional pipeline, when `batch_size` messages are
+    collected or `max_delay` seconds passed since the first of them was taken from the queue.
+    With a `history` assigning the ids when publishing (see `MessageHistory.ids_published`),
+    each batch is passed through `history.publish` first, e.g. added to Redis streams.
+    """
+    BLOCK = 'block'  # wait until there is free space in the queue
+    DROP_NEWEST = 'drop_newest'  # discard the message being published
+    DROP_OLDEST = 'drop_oldest'  # discard the oldest queued message
+    OVERFLOW_POLICIES = (BLOCK, DROP_NEWEST, DROP_OLDEST)
+
+    def __init__(self, redis_client, channel_prefix='', max_queue_size=10000, batch_size=100,
+                 max_delay=0.001, overflow_policy=BLOCK):
+        """
+        Args:
+            redis_client (redis.StrictRedis): client to publish with
+            channel_prefix (str): prefix of the Redis channels
+            max_queue_size (int): maximum number of messages waiting to be published
+            batch_size (int): maximum number of messages sent in one pipeline
+            max_delay (float): maximum number of seconds to wait for a batch to fill
+            overflow_policy (str): what to do when the queue is full (because Redis is slow),
+                one of OVERFLOW_POLICIES
+        """
+        if overflow_policy not in self.OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy: %r' % overflow_policy)
+        self.redis_client = redis_client
+        self.channel_prefix = channel_prefix
+        self.queue = gevent.queue.Queue(max_queue_size)
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.overflow_policy = overflow_policy
+        self.published_count = 0
+        self.dropped_count = 0
+        self.failed_count = 0
+        self.flush_count = 0
+        self.last_flush_size = 0
+        self.max_flush_size = 0
+        self.metrics = Metrics(enabled=False)
+        self.history = None  # see `Broker.set_history`
+        self._flush_messages()
+
+    def publish(self, message, channel):
+        """Queue a message to be published on the given channel.
+        """
+        item = (channel, message)
+        if self.overflow_policy == self.BLOCK:
+            self.queue.put(item)
+            return
+        try:
+            self.queue.put_nowait(item)
+        except gevent.queue.Full:
+            self.dropped_count += 1
+            if self.overflow_policy == self.DROP_OLDEST:
+                self.queue.get_nowait()
+                self.queue.put_nowait(item)
+
+    def publish_many(self, messages):
+        """Queue (channel, message) pairs to be published. They are sent in pipelines of up to
+        `batch_size` messages.
+        """
+        for channel, message in messages:
+            self.publish(message, channel)
+
+    @async
+    def _flush_messages(self):
+        """Get messages from the queue and PUBLISH them in batches.
+        """
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.max_delay
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.time()
+                try:
+                    if timeout > 0:
+                        batch.append(self.queue.get(timeout=timeout))
+                    else:  # take only what is already queued
+                        batch.append(self.queue.get_nowait())
+                except gevent.queue.Empty:
+                    break
+            self._flush(batch)
+
+    def _flush(self, batch):
+        """PUBLISH the given (channel, message) pairs in one round trip.
+        """
+        if self.history is not None:
+            batch = list(self.history.publish(batch))
+        redis_pipeline = self.redis_client.pipeline(transaction=False)
+        for channel, message in batch:
+            redis_pipeline.publish(self.channel_prefix + channel, message)
+        started_at = time.time()
+        try:
+            redis_pipeline.execute()
+        except redis.RedisError:
+            self.failed_count += len(batch)
+            logger.exception('Failed to publish %d messages', len(batch))
+        else:
+            self.published_count += len(batch)
+            self.metrics.observe('websocket_redis_publish_seconds', time.time() - started_at)
+        self.flush_count += 1
+        self.last_flush_size = len(batch)
+        self.max_flush_size = max(self.max_flush_size, len(batch))
+
+    def stats(self):
+        """Return the counters of the publisher.
+        """
+        return {
+            'queue_size': self.queue.qsize(),
+            'published': self.published_count,
+            'dropped': self.dropped_count,
+            'failed': self.failed_count,
+            'flushes': self.flush_count,
+            'last_flush_size': self.last_flush_size,
+            'max_flush_size': self.max_flush_size,
+        }
+
+
+def get_subscription_channels(channel, prefix=False):
+    """Return the channels on which messages for websockets of the given channel can be published:
+    the channel itself and the sub-channel broadcasts of its ancestors, except the root one (`/`).
+    E.g. for `a/b/c` these are `a/b/c`, `a/` and `a/b/`. For all the sub-channels of `a/b`
+    (`prefix`) these are `a/b/*` (see `RedisSubscriptions`) and `a/`.
+    """
+    names = channel.split('/')
+    return ([channel + '/*' if prefix else channel] +
+            ['/'.join(names[:i]) + '/' for i in xrange(1, len(names))])
+
+
+class RedisSubscriptions(object):
+    """Reference counted subscriptions of a pubsub connection, so that a worker receives only
+    messages of the channels it has websockets on. Changes are sent to Redis in batches by a
+    greenlet.
+
+    A channel ending with `*` stands for all the channels starting with the rest of it, which is
+    subscribed to with PSUBSCRIBE. Such channels are in `patterns` once Redis confirms the
+    subscription (see `confirm`), as only then it sends their messages.
+    """
+    def __init__(self, pubsub, channel_prefix='', permanent_channels=(), batch_delay=0.005):
+        """
+        Args:
+            pubsub (redis.client.PubSub): the pubsub connection
+            channel_prefix (str): prefix of the Redis channels
+            permanent_channels (tuple): channels to be always subscribed to
+            batch_delay (float): number of seconds to collect changes before sending them
+        """
+        self.pubsub = pubsub
+        self.channel_prefix = channel_prefix
+        self.permanent_channels = tuple(permanent_channels)
+        self.batch_delay = batch_delay
+        self.counts = collections.Counter()  # channel -> how many times it was added
+        self.patterns = set()  # channels ending with `*` Redis sends the messages of
+        self._subscribed = set()
+        self._changed_channels = set()
+        self._changed = gevent.event.Event()
+        self._has_subscriptions = gevent.event.Event()  # set when channels are subscribed to
+        self._update_subscriptions()
+
+    def add(self, channels):
+        """Increase the reference counts of the channels, subscribing to the new ones.
+        """
+        counts = self.counts
+        for channel in channels:
+            counts[channel] += 1
+            if counts[channel] == 1:
+                self._changed_channels.add(channel)
+                self._changed.set()
+
+    def discard(self, channels):
+        """Decrease the reference counts of the channels, unsubscribing from the unused ones.
+        """
+        counts = self.counts
+        for channel in channels:
+            counts[channel] -= 1
+            if counts[channel] <= 0:
+                del counts[channel]
+                self._changed_channels.add(channel)
+                self._changed.set()
+
+    def get_pattern(self, channel):
+        """Return the shortest subscribed pattern matching the given channel, or None.
+        """
+        patterns = self.patterns
+        if not patterns:
+            return None
+        if '*' in patterns:
+            return '*'
+        position = channel.find('/')
+        while position != -1:
+            pattern = channel[:position + 1] + '*'
+            if pattern in patterns:
+                return pattern
+            position = channel.find('/', position + 1)
+        return None
+
+    def get_redis_pattern(self, pattern):
+        """Return the Redis pattern of a channel ending with `*`.
+        """
+        return self.channel_prefix + re.sub(r'([*?\[\]\\])', r'\\\1', pattern[:-1]) + '*'
+
+    def confirm(self, reply):
+        """Update `patterns` with a reply of Redis to subscribing or unsubscribing. Messages
+        published before the reply were sent according to the previous subscriptions.
+        """
+        if reply['type'] in ('psubscribe', 'punsubscribe'):
+            pattern = reply['channel'][len(self.channel_prefix):-1]
+            channel = re.sub(r'\\(.)', r'\1', pattern) + '*'  # see `get_redis_pattern`
+            if reply['type'] == 'psubscribe':
+                self.patterns.add(channel)
+            else:
+                self.patterns.discard(channel)
+
+    def _subscribe(self, channels):
+        names = [self.channel_prefix + channel for channel in channels
+                 if not channel.endswith('*')]
+        patterns = [self.get_redis_pattern(channel) for channel in channels
+                    if channel.endswith('*')]
+        if names:
+            self.pubsub.subscribe(*names)
+        if patterns:
+            self.pubsub.psubscribe(*patterns)
+        if names or patterns:
+            self._has_subscriptions.set()
+
+    def _unsubscribe(self, channels):
+        names = [self.channel_prefix + channel for channel in channels
+                 if not channel.endswith('*')]
+        patterns = [self.get_redis_pattern(channel) for channel in channels
+                    if channel.endswith('*')]
+        if names:
+            self.pubsub.unsubscribe(*names)
+        if patterns:
+            self.pubsub.punsubscribe(*patterns)
+
+    def wait(self):
+        """Block until the pubsub connection is subscribed to some channels. Listening to it
+        returns at once while it isn't.
+        """
+        while not self.pubsub.subscribed:
+            self._has_subscriptions.clear()
+            self._has_subscriptions.wait()
+
+    def subscribe_all(self):
+        """SUBSCRIBE to all the channels in use, e.g. after reconnecting to Redis.
+        """
+        channels = set(self.counts)
+        self.patterns.clear()  # to be confirmed again
+        self._subscribe(channels.union(self.permanent_channels))
+        self._subscribed = channels
+
+    @async
+    def _update_subscriptions(self):
+        """SUBSCRIBE to and UNSUBSCRIBE from the changed channels in batches.
+        """
+        while True:
+            self._changed.wait()
+            gevent.sleep(self.batch_delay)
+            self._changed.clear()
+            changed_channels, self._changed_channels = self._changed_channels, set()
+            subscribe = [channel for channel in changed_channels
+                         if channel in self.counts and channel not in self._subscribed]
+            unsubscribe = [channel for channel in changed_channels
+                           if channel not in self.counts and channel in self._subscribed]
+            try:
+                if subscribe:
+                    self._subscribe(subscribe)
+                    self._subscribed.update(subscribe)
+                if unsubscribe:
+                    self._unsubscribe(unsubscribe)
+                    self._subscribed.difference_update(unsubscribe)
+            except redis.RedisError:
+                # the listener will reconnect and call `subscribe_all`
+                logger.warning('Failed to update Redis subscriptions', exc_info=True)
+
+
+class Broker(object):
+    """Delivers published messages to the workers having websockets on their channels.
+    Subclasses implement the transport.
+    """
+    def start(self, deliver, metrics=None):
+        """Start receiving published messages.
+
+        Args:
+            deliver (callable): called with a list of (channel, message) pairs received at once
+            metrics (Metrics): where to record the metrics of the broker
+        """
+        self.deliver = deliver
+        self.metrics = Metrics(enabled=False) if metrics is None else metrics
+
+    def publish(self, message, channel):
+        """Publish a message on the given channel.
+        """
+        raise NotImplementedError
+
+    def publish_many(self, messages):
+        """Publish (channel, message) pairs, in the given order. Subclasses send them at once if
+        the transport allows it.
+        """
+        for channel, message in messages:
+            self.publish(message, channel)
+
+    def set_history(self, history):
+        """Have the broker pass the messages through `history.publish` as it publishes them, for
+        a history assigning the ids when publishing (see `MessageHistory.ids_published`).
+
+        Returns:
+            bool: whether the broker does it; if not, the messages are to be passed through
+                `history.publish` before they are given to the broker
+        """
+        return False
+
+    def subscribe(self, channels):
+        """Tell the broker that messages of the given channels are needed by this worker.
+        Each call must be paired with an `unsubscribe` call with the same channels.
+        """
+
+    def unsubscribe(self, channels):
+        """Tell the broker that messages of the given channels are no longer needed by a
+        websocket of this worker.
+        """
+
+    def close(self):
+        """Release the resources of the broker.
+        """
+
+    def stats(self):
+        """Return the counters of the broker. Nested dicts are named by their keys; lists hold
+        (labels, dict) pairs of the same counters, e.g. for each shard.
+        """
+        return {}
+
+
+class InProcessBroker(Broker):
+    """Delivers messages directly to the websockets of this process, without any network hops.
+    Suitable only when there is a single worker.
+    """
+    def __init__(self):
+        self._messages = []
+        self._has_messages = gevent.event.Event()
+        self.published_count = 0
+
+    def start(self, deliver, metrics=None):
+        super(InProcessBroker, self).start(deliver, metrics)
+        self._deliver_messages()
+
+    def publish(self, message, channel):
+        self._messages.append((channel, message))
+        self._has_messages.set()
+        self.published_count += 1
+
+    def publish_many(self, messages):
+        count = len(self._messages)
+        self._messages.extend(messages)
+        self._has_messages.set()
+        self.published_count += len(self._messages) - count
+
+    @async
+    def _deliver_messages(self):
+        """Deliver the published messages in batches, in the order they were published.
+        """
+        while True:
+            self._has_messages.wait()
+            self._has_messages.clear()
+            messages, self._messages = self._messages, []
+            self.deliver(messages)
+
+    def stats(self):
+        return {'published': self.published_count}
+
+
+class UnixSocketBroker(Broker):
+    """Fans messages out between the workers on one host, without external services. Every
+    worker binds a Unix datagram socket in `socket_dir`, and a message is published by sending it
+    to all the sockets there, including the own one. A message larger than a datagram is sent
+    in fragments, which the workers put together by the pid of their sender.
+    """
+    WHOLE = '\0'  # first byte of a datagram of whole messages
+    FIRST_FRAGMENT = '\1'  # first byte of the first fragment, followed by FIRST_HEADER
+    NEXT_FRAGMENT = '\2'  # first byte of the other fragments, followed by NEXT_HEADER
+    FIRST_HEADER = struct.Struct('!II')  # pid of the sender, size of the fragmented datagram
+    NEXT_HEADER = struct.Struct('!I')  # pid of the sender
+    SEND_TIMEOUT = 1.0  # seconds to wait for a worker to make room for a datagram
+
+    def __init__(self, socket_dir='/tmp/websocket-channels', max_message_size=65536,
+                 peers_refresh_interval=1.0):
+        """
+        Args:
+            socket_dir (str): directory with the sockets of the workers
+            max_message_size (int): maximum size of a datagram (channel + message), larger
+                messages are fragmented
+            peers_refresh_interval (float): how often to look for sockets of new workers, in
+                seconds
+        """
+        self.socket_dir = socket_dir
+        self.max_message_size = max_message_size
+        self.peers_refresh_interval = peers_refresh_interval
+        self.address = None
+        self.socket = None
+        self._peers = []
+        self._peers_refreshed_at = 0
+        self._receiver = None
+        self._fragments = {}  # pid -> [size of the datagram missing, fragments received]
+        self._fragmenting = gevent.lock.Semaphore()  # fragments of data mustn't interleave
+        self.published_count = 0
+        self.failed_count = 0
+        self.fragmented_count = 0
+
+    def start(self, deliver, metrics=None):
+        super(UnixSocketBroker, self).start(deliver, metrics)
+        try:
+            os.makedirs(self.socket_dir)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        self.address = os.path.join(self.socket_dir, '%d.sock' % os.getpid())
+        if os.path.exists(self.address):  # left by a dead process with the same pid
+            os.unlink(self.address)
+        self.socket = gevent.socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(self.address)
+        self._receiver = self._receive_messages()
+
+    def publish(self, message, channel):
+        if isinstance(channel, unicode):
+            channel = channel.encode('utf-8')
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+        self._send_datagram(self.WHOLE + channel + '\0' + message)
+        self.published_count += 1
+
+    def _send_datagram(self, datagram):
+        """Send a datagram of whole messages to all the workers, in fragments if it's larger
+        than `max_message_size`.
+        """
+        if len(datagram) <= self.max_message_size:
+            self._send_to_peers(datagram)
+            return
+        pid = os.getpid()
+        header = self.FIRST_FRAGMENT + self.FIRST_HEADER.pack(pid, len(datagram))
+        next_header = self.NEXT_FRAGMENT + self.NEXT_HEADER.pack(pid)
+        with self._fragmenting:
+            position = self.max_message_size - len(header)
+            self._send_to_peers(header + datagram[:position])
+            while position < len(datagram):
+                end = position + self.max_message_size - len(next_header)
+                self._send_to_peers(next_header + datagram[position:end])
+                position = end
+        self.fragmented_count += 1
+
+    def _send_to_peers(self, datagram):
+        """Send a datagram to all the workers.
+        """
+        for peer in self._get_peers():
+            try:
+                if not self.socket.sendto(datagram, peer) and not self._resend(datagram, peer):
+                    self.failed_count += 1
+                    logger.warning('Failed to send a message to `%s`: its queue is full', peer)
+            except socket.error as exc:
+                if exc.errno in (errno.ECONNREFUSED, errno.ENOENT):  # the worker is gone
+                    self._remove_peer(peer)
+                else:
+                    self.failed_count += 1
+                    logger.warning('Failed to send a message to `%s`: %s', peer, exc)
+
+    def _resend(self, datagram, peer):
+        """Send a datagram to a worker whose socket queue was full (gevent's `sendto` returns 0
+        then instead of sending), waiting up to `SEND_TIMEOUT` seconds for it to make room.
+
+        Returns:
+            bool: whether the datagram was sent
+        """
+        delay = 0.001
+        deadline = time.time() + self.SEND_TIMEOUT
+        while time.time() < deadline:
+            gevent.sleep(delay)
+            if self.socket.sendto(datagram, peer):
+                return True
+            delay = min(delay * 2, 0.05)
+        return False
+
+    def _get_peers(self):
+        """Return addresses of the sockets of all the workers, refreshing them periodically.
+        """
+        now = time.time()
+        if now - self._peers_refreshed_at > self.peers_refresh_interval:
+            self._peers = [os.path.join(self.socket_dir, name)
+                           for name in os.listdir(self.socket_dir) if name.endswith('.sock')]
+            self._peers_refreshed_at = now
+        return self._peers
+
+    def _remove_peer(self, peer):
+        """Forget the socket of a dead worker and remove its file.
+        """
+        if peer in self._peers:
+            self._peers.remove(peer)
+        try:
+            os.unlink(peer)
+        except OSError:
+            pass
+
+    @async
+    def _receive_messages(self):
+        """Receive messages published by the workers and deliver them.
+        """
+        while True:
+            datagram = self.socket.recv(self.max_message_size)
+            if datagram[0] != self.WHOLE:
+                datagram = self._join_fragments(datagram)
+                if datagram is None:
+                    continue
+            self.deliver(self._decode_datagram(datagram))
+
+    def _join_fragments(self, fragment):
+        """Collect a fragment of a datagram.
+
+        Returns:
+            str: the datagram of whole messages, once its last fragment is received; else None
+        """
+        if fragment[0] == self.FIRST_FRAGMENT:
+            pid, size = self.FIRST_HEADER.unpack_from(fragment, 1)
+            fragment = fragment[1 + self.FIRST_HEADER.size:]
+            fragments = self._fragments[pid] = [size, []]
+        else:
+            pid, = self.NEXT_HEADER.unpack_from(fragment, 1)
+            fragments = self._fragments.get(pid)
+            if fragments is None:  # the first fragment was lost
+                return None
+            fragment = fragment[1 + self.NEXT_HEADER.size:]
+        fragments[0] -= len(fragment)
+        fragments[1].append(fragment)
+        if fragments[0] > 0:
+            return None
+        del self._fragments[pid]
+        return ''.join(fragments[1])
+
+    def _decode_datagram(self, datagram):
+        """Return the (channel, message) pairs sent in a datagram of whole messages.
+        """
+        separator = datagram.index('\0', 1)
+        return [(datagram[1:separator], datagram[separator + 1:])]
+
+    def close(self):
+        if self._receiver is not None:
+            self._receiver.kill()
+            self._receiver = None
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+            os.unlink(self.address)
+
+    def stats(self):
+        return {'published': self.published_count, 'failed': self.failed_count,
+                'fragmented': self.fragmented_count, 'workers': len(self._peers)}
+
+
+class RedisBrokerMixin(object):
+    """Publishing through a `RedisPublisher` and listening to a pubsub connection, shared by
+    the brokers using Redis Pub/Sub.
+    """
+    CHANNEL_PREFIX = 'websocket:'
+    RECONNECT_DELAY = 0.1  # initial delay before reconnecting to Redis, doubled each try
+    RECONNECT_MAX_DELAY = 5
+
+    def _connect(self, redis_url, publish_queue_size, publish_batch_size, publish_max_delay,
+                 publish_overflow_policy):
+        """Create the Redis client and the publisher, see `RedisPublisher` for the options.
+        """
+        self.redis_client = redis.from_url(redis_url)
+        self.publisher = RedisPublisher(
+            self.redis_client, self.CHANNEL_PREFIX, max_queue_size=publish_queue_size,
+            batch_size=publish_batch_size, max_delay=publish_max_delay,
+            overflow_policy=publish_overflow_policy)
+
+    def start(self, deliver, metrics=None):
+        super(RedisBrokerMixin, self).start(deliver, metrics)
+        self.publisher.metrics = self.metrics
+
+    def publish(self, message, channel):
+        self.publisher.publish(message, channel)
+
+    def publish_many(self, messages):
+        self.publisher.publish_many(messages)
+
+    def set_history(self, history):
+        self.publisher.history = history  # added in the batches, off the publishing greenlet
+        return True
+
+    def _listen_to_pubsub(self, pubsub, subscribe, receive, wait=None):
+        """Receive the messages of a pubsub connection, forever. Blocks on the connection, so a
+        message is handled as soon as it arrives, and all the messages already buffered are
+        taken in the same wakeup. When the connection to Redis is lost, reconnects and
+        subscribes again.
+        See: https://github.com/andymccurdy/redis-py#publish--subscribe
+
+        Args:
+            pubsub (redis.client.PubSub): the pubsub connection
+            subscribe (callable): subscribes the connection, after (re)connecting
+            receive (callable): called with a list of the messages taken at once
+            wait (callable): if given, blocks until the connection is subscribed to some
+                channels, as listening returns at once while it isn't
+        """
+        reconnect_delay = self.RECONNECT_DELAY
+        while True:
+            try:
+                subscribe()
+                while True:
+                    if wait is not None:
+                        wait()
+                    for message in pubsub.listen():
+                        reconnect_delay = self.RECONNECT_DELAY
+                        messages = [message]
+                        message = pubsub.get_message()
+                        while message:  # drain the messages which have already arrived
+                            messages.append(message)
+                            message = pubsub.get_message()
+                        receive(messages)
+            except (redis.ConnectionError, redis.TimeoutError):
+                logger.warning('Lost connection to Redis, reconnecting in %.1f sec.',
+                               reconnect_delay, exc_info=True)
+                pubsub.reset()
+                gevent.sleep(reconnect_delay)
+                reconnect_delay = min(reconnect_delay * 2, self.RECONNECT_MAX_DELAY)
+
+
+class RedisBroker(RedisBrokerMixin, Broker):
+    """Delivers messages using Redis Pub/Sub, so all connected clients receive them, even if
+    there are several Gunicorn workers/machines.
+    """
+    MESSAGE_TYPES = ('message', 'pmessage')  # the others are replies to (un)subscribing
+
+    def __init__(self, redis_url, publish_queue_size=10000, publish_batch_size=100,
+                 publish_max_delay=0.001, publish_overflow_policy=RedisPublisher.BLOCK,
+                 permanent_channels=('/',)):
+        """
+        Args:
+            redis_url (str): URL of the Redis server
+            publish_queue_size, publish_batch_size, publish_max_delay, publish_overflow_policy:
+                options of the `RedisPublisher`
+            permanent_channels (tuple): channels to be always subscribed to; messages to `/` are
+                for all the websockets, so some are always needed
+        """
+        self._connect(redis_url, publish_queue_size, publish_batch_size, publish_max_delay,
+                      publish_overflow_policy)
+        self.pubsub = self.redis_client.pubsub()  # the replies confirm the subscriptions
+        self.subscriptions = RedisSubscriptions(self.pubsub, self.CHANNEL_PREFIX,
+                                                permanent_channels=permanent_channels)
+
+    def start(self, deliver, metrics=None):
+        super(RedisBroker, self).start(deliver, metrics)
+        self._listen()
+
+    def subscribe(self, channels):
+        self.subscriptions.add(channels)
+
+    def unsubscribe(self, channels):
+        self.subscriptions.discard(channels)
+
+    @async
+    def _listen(self):
+        """Listen in a thread for new messages in Redis, and deliver them. Only channels having
+        websockets in this worker are subscribed to; the connection waits while there are
+        none, e.g. in a shard without websockets on its channels.
+        """
+        subscriptions = self.subscriptions
+        self._listen_to_pubsub(self.pubsub, subscriptions.subscribe_all, self._receive,
+                               subscriptions.wait)
+
+    def _receive(self, messages):
+        """Deliver messages received from Redis at once.
+        A message matching subscribed patterns is received once for each of them and for its
+        channel, so only the one for the shortest pattern is delivered; the patterns are those
+        Redis confirmed subscribing to when the message was published, see `RedisSubscriptions`.
+        """
+        channel_prefix_len = len(self.CHANNEL_PREFIX)
+        subscriptions = self.subscriptions
+        delivered = []
+        for message in messages:
+            if message['type'] not in self.MESSAGE_TYPES:
+                subscriptions.confirm(message)
+            elif (not subscriptions.patterns or
+                    self._is_delivered(message, channel_prefix_len)):
+                delivered.append((message['channel'][channel_prefix_len:], message['data']))
+        if delivered:
+            self.deliver(delivered)
+
+    def _is_delivered(self, message, channel_prefix_len):
+        """Return whether a message received while patterns are subscribed is to be delivered,
+        i.e. it isn't a duplicate.
+        """
+        pattern = self.subscriptions.get_pattern(message['channel'][channel_prefix_len:])
+        if pattern is None:
+            return True
+        return (message['type'] == 'pmessage'
+                and message['pattern'] == self.subscriptions.get_redis_pattern(pattern))
+
+    def close(self):
+        self.pubsub.close()
+
+    def stats(self):
+        return {'publisher': self.publisher.stats(),
+                'subscribed_channels': len(self.subscriptions.counts)}
+
+
+class HashRing(object):
+    """Consistent hashing of keys to nodes: each node is placed at many points of a ring, and a
+    key belongs to the node of the first point after the hash of the key. Adding or removing a
+    node moves only the keys of its own points.
+    """
+    def __init__(self, nodes, points_per_node=160):
+        """
+        Args:
+            nodes (list): names of the nodes (str)
+            points_per_node (int): points of each node on the ring; more give a more even spread
+        """
+        ring = sorted((self._hash('%s#%d' % (node, number)), node)
+                      for node in nodes for number in xrange(points_per_node))
+        self._points = [point for point, _ in ring]
+        self._nodes = [node for _, node in ring]
+
+    @staticmethod
+    def _hash(key):
+        return struct.unpack('!I', hashlib.md5(key).digest()[:4])[0]
+
+    def get(self, key):
+        """Return the node the given key (str) belongs to.
+        """
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        index = bisect.bisect(self._points, self._hash(key))
+        return self._nodes[index % len(self._nodes)]
+
+
+class ShardedBroker(Broker):
+    """Spreads the channels over several brokers by consistent hashing of their top-level name,
+    e.g. `users` for `users/42`, so all the channels of a tree, its sub-channel broadcasts
+    (`users/`) included, are on the same shard. Broadcasts to `/` are on the shard of the empty
+    name. The order of messages is kept per shard only.
+    """
+    ROUTE_CACHE_SIZE = 10000  # top-level names whose shard is remembered
+
+    def __init__(self, shards):
+        """
+        Args:
+            shards (dict): brokers by shard name; the names must be the same in all the workers
+                and stay the same when shards are added, so most channels keep their shard
+        """
+        self.shards = shards
+        self.ring = HashRing(sorted(shards))
+        self._routes = {}
+
+    def get_shard(self, channel):
+        """Return the broker of the given channel.
+        """
+        name = channel.split('/', 1)[0]
+        shard = self._routes.get(name)
+        if shard is None:
+            if len(self._routes) >= self.ROUTE_CACHE_SIZE:
+                self._routes.popitem()
+            shard = self._routes[name] = self.shards[self.ring.get(name)]
+        return shard
+
+    def start(self, deliver, metrics=None):
+        super(ShardedBroker, self).start(deliver, metrics)
+        for shard in self.shards.itervalues():
+            shard.start(deliver, self.metrics)
+
+    def publish(self, message, channel):
+        self.get_shard(channel).publish(message, channel)
+
+    def publish_many(self, messages):
+        shard_messages = collections.defaultdict(list)
+        for channel, message in messages:
+            shard_messages[self.get_shard(channel)].append((channel, message))
+        for shard, messages in shard_messages.iteritems():
+            shard.publish_many(messages)
+
+    def set_history(self, history):
+        return all([shard.set_history(history) for shard in self.shards.itervalues()])
+
+    def subscribe(self, channels):
+        for shard, channels in self._group_by_shard(channels):
+            shard.subscribe(channels)
+
+    def unsubscribe(self, channels):
+        for shard, channels in self._group_by_shard(channels):
+            shard.unsubscribe(channels)
+
+    def _group_by_shard(self, channels):
+        """Return (broker, channels) pairs of the given channels, see `get_shard`.
+        """
+        shard_channels = collections.defaultdict(list)
+        for channel in channels:
+            shard_channels[self.get_shard(channel)].append(channel)
+        return shard_channels.iteritems()
+
+    def close(self):
+        for shard in self.shards.itervalues():
+            shard.close()
+
+    def stats(self):
+        return {'shards': [({'shard': name}, shard.stats())
+                           for name, shard in sorted(self.shards.iteritems())]}
+
+
+class ShardedRedisBroker(ShardedBroker):
+    """A `ShardedBroker` over several Redis servers, so the publishing throughput isn't limited by
+    one Redis core. Each shard is a `RedisBroker`, with its own pool of connections for
+    publishing and its own subscription. All the workers must be given the same URLs.
+    """
+    def __init__(self, redis_urls, **options):
+        """
+        Args:
+            redis_urls (list): URLs of the Redis servers, which are also the names of the shards
+            options: options of the `RedisBroker` of each shard
+        """
+        ring = HashRing(sorted(redis_urls))
+        root_shard = ring.get('')  # only this one receives the messages to `/`
+        super(ShardedRedisBroker, self).__init__({
+            redis_url: RedisBroker(redis_url, permanent_channels=(
+                ('/',) if redis_url == root_shard else ()), **options)
+            for redis_url in redis_urls})
+
+
+class HostRedisBroker(RedisBrokerMixin, UnixSocketBroker):
+    """Delivers messages using Redis Pub/Sub like `RedisBroker`, but with one subscription per
+    host instead of one per worker, so Redis sends each message to a host once. The workers of a
+    host elect a leader with a lock file in `socket_dir`; the leader subscribes to all the
+    channels and forwards the messages to all the workers, itself included, through their Unix
+    datagram sockets (see `UnixSocketBroker`), in batches. When the leader exits, the lock is
+    released and another worker takes over within `leader_retry_interval`; messages published
+    meanwhile are lost. Every worker publishes to Redis itself.
+
+    As the leader subscribes to all the channels, every worker receives the messages of all of
+    them, also of those it has no websockets on, unlike with `RedisBroker`. This trades the CPU
+    time of the workers for fewer Redis connections and less traffic from Redis, so it suits
+    hosts whose workers have websockets on most of the busy channels.
+    """
+    LOCK_FILE_NAME = 'leader.lock'
+    RECORD_HEADER = struct.Struct('!II')  # sizes of the channel and the message
+
+    def __init__(self, redis_url, socket_dir='/tmp/websocket-channels-redis',
+                 max_message_size=65536, peers_refresh_interval=1.0, leader_retry_interval=1.0,
+                 publish_queue_size=10000, publish_batch_size=100, publish_max_delay=0.001,
+                 publish_overflow_policy=RedisPublisher.BLOCK):
+        """
+        Args:
+            redis_url (str): URL of the Redis server
+            socket_dir, max_message_size, peers_refresh_interval: see `UnixSocketBroker`; the
+                messages forwarded at once are sent in datagrams of up to `max_message_size`
+            leader_retry_interval (float): how often a worker tries to become the leader, in
+                seconds
+            publish_queue_size, publish_batch_size, publish_max_delay, publish_overflow_policy:
+                options of the `RedisPublisher`
+        """
+        super(HostRedisBroker, self).__init__(socket_dir, max_message_size,
+                                              peers_refresh_interval)
+        self._connect(redis_url, publish_queue_size, publish_batch_size, publish_max_delay,
+                      publish_overflow_policy)
+        self.leader_retry_interval = leader_retry_interval
+        self.pubsub = None  # only in the leader
+        self.is_leader = False
+        self.forwarded_count = 0
+        self._lock_file = None
+        self._leader = None  # the greenlet waiting to lead or forwarding the messages
+
+    def start(self, deliver, metrics=None):
+        super(HostRedisBroker, self).start(deliver, metrics)
+        self._leader = self._lead()
+
+    @async
+    def _lead(self):
+        """Wait to become the leader of the host, then forward the messages from Redis.
+        """
+        lock_file = open(os.path.join(self.socket_dir, self.LOCK_FILE_NAME), 'a')
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except IOError as exc:
+                if exc.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+            gevent.sleep(self.leader_retry_interval)
+        self._lock_file = lock_file
+        self.is_leader = True
+        logger.info('Worker %d receives the messages from Redis for the host', os.getpid())
+        self.pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+        self._forward_messages()
+
+    def _forward_messages(self):
+        """Listen for the messages of all the channels in Redis and forward them to the
+        workers, all the messages already buffered at once.
+        """
+        self._listen_to_pubsub(
+            self.pubsub, functools.partial(self.pubsub.psubscribe, self.CHANNEL_PREFIX + '*'),
+            self._forward)
+
+    def _forward(self, messages):
+        """Send messages received from Redis to all the workers, as few datagrams as possible.
+        """
+        channel_prefix_len = len(self.CHANNEL_PREFIX)
+        records = [self.WHOLE]
+        size = 1
+        for message in messages:
+            channel = message['channel'][channel_prefix_len:]
+            data = message['data']
+            record = self.RECORD_HEADER.pack(len(channel), len(data)) + channel + data
+            if size > 1 and size + len(record) > self.max_message_size:
+                self._send_datagram(''.join(records))
+                records = [self.WHOLE]
+                size = 1
+            records.append(record)
+            size += len(record)
+        if size > 1:
+            self._send_datagram(''.join(records))
+        self.forwarded_count += len(messages)
+
+    def _decode_datagram(self, datagram):
+        messages = []
+        position = 1  # after `WHOLE`
+        header_size = self.RECORD_HEADER.size
+        while position < len(datagram):
+            channel_size, message_size = self.RECORD_HEADER.unpack_from(datagram, position)
+            position += header_size + channel_size
+            messages.append((datagram[position - channel_size:position],
+                             datagram[position:position + message_size]))
+            position += message_size
+        return messages
+
+    def close(self):
+        if self._leader is not None:
+            self._leader.kill()
+            self._leader = None
+        if self.pubsub is not None:
+            self.pubsub.close()
+        if self._lock_file is not None:
+            self._lock_file.close()  # releases the lock
+            self._lock_file = None
+        super(HostRedisBroker, self).close()
+
+    def stats(self):
+        return {'publisher': self.publisher.stats(), 'leader': int(self.is_leader),
+                'forwarded': self.forwarded_count, 'failed': self.failed_count,
+                'fragmented': self.fragmented_count, 'workers': len(self._peers)}
+
+
+class WebSocketConnection(object):
+    """A websocket handled by this worker. Frames sent to it are put into its own bounded queue
+    and written to the socket by a separate greenlet, so a slow client doesn't delay sending
+    messages to other clients.
+    """
+    DROP_OLDEST = 'drop_oldest'  # discard the oldest queued message
+    DROP_NEWEST = 'drop_newest'  # discard the message being sent
+    DISCONNECT = 'disconnect'  # drop the slow client
+    OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST, DISCONNECT)
+
+    prefix = False  # registered on the channel itself, see `ChannelSubscription`
+    attributes = {}  # see `MessagePipeline`, never modified
+
+    def __init__(self, websocket, channel, max_queue_size=100, overflow_policy=DROP_OLDEST,
+                 metrics=None, with_ids=False, multiplexed=False):
+        """
+        Args:
+            websocket (geventwebsocket.websocket.WebSocket): the websocket
+            channel (str): the channel the websocket is registered on; None if multiplexed
+            max_queue_size (int): maximum number of frames waiting to be sent
+            overflow_policy (str): what to do when the queue is full, one of OVERFLOW_POLICIES
+            metrics (Metrics): where to count dropped messages, slow clients and failures
+            with_ids (bool): whether the client is sent messages with their history ids
+            multiplexed (bool): whether the client subscribes to channels with control messages
+                and is sent messages tagged with their channels
+        """
+        if overflow_policy not in self.OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy: %r' % overflow_policy)
+        self.websocket = websocket
+        self.channel = channel
+        self.queue = collections.deque()
+        self.max_queue_size = max_queue_size
+        self.overflow_policy = overflow_policy
+        self.metrics = Metrics(enabled=False) if metrics is None else metrics
+        self.channel_sockets = None  # the ChannelSockets node the websocket is registered on
+        # whether compressed frames are sent to it
+        self.deflate = isinstance(websocket, DeflateWebSocket)
+        self.with_ids = with_ids
+        self.subscriptions = {}  # (channel, prefix) -> ChannelSubscription, if multiplexed
+        self.last_multiplexed_frame = None  # sent once to overlapping subscriptions
+        # which of the frames of a message it is sent, see `_encode_frames` of the middleware
+        self.frame_type = self.deflate + (4 if multiplexed else 2 * with_ids)
+        self.created_at = time.time()
+        self.ping_sent_at = None  # when it was pinged if no pong has been received since
+        self.dropped_count = 0
+        self.closed = False
+        self.close_status = None  # (code, reason) to close the websocket with, see `shutdown`
+        self._has_messages = gevent.event.Event()
+        self._writer = gevent.spawn(self._write_messages)
+
+    @property
+    def received_at(self):
+        """When the last frame was received from the client (see `TimedWebSocket`), or when the
+        connection was made.
+        """
+        return getattr(self.websocket.handler, 'frame_received_at', self.created_at)
+
+    def send_frame(self, frame):
+        """Queue a frame (see `encode_frame`) to be written to the websocket. Never blocks.
+
+        Returns:
+            bool: False if the connection is closed
+        """
+        if self.closed:
+            return False
+        queue = self.queue
+        if len(queue) >= self.max_queue_size:
+            self.dropped_count += 1
+            self.metrics.increment('websocket_send_queue_dropped_total')
+            if self.overflow_policy == self.DROP_NEWEST:
+                return True
+            elif self.overflow_policy == self.DROP_OLDEST:
+                queue.popleft()
+            else:
+                logger.warning('Disconnecting slow client on channel `%s`', self.channel)
+                self.metrics.increment('websocket_slow_clients_disconnected_total')
+                self.disconnect()
+                return False
+        queue.append(frame)
+        self._has_messages.set()
+        return True
+
+    def send_frames(self, frames, first=False):
+        """Queue frames regardless of the size of the queue, e.g. messages missed by a
+        reconnected client.
+
+        Args:
+            frames (list): the frames
+            first (bool): whether to write them before the already queued ones
+        """
+        if self.closed or not frames:
+            return
+        if first:
+            self.queue.extendleft(reversed(frames))
+        else:
+            self.queue.extend(frames)
+        self._has_messages.set()
+
+    def _write_messages(self):
+        """Write queued frames to the websocket until the connection is closed.
+        """
+        queue = self.queue
+        websocket = self.websocket
+        while not self.closed:
+            self._has_messages.wait()
+            self._has_messages.clear()
+            while queue and not self.closed:
+                if websocket.closed:
+                    self.close()
+                    break
+                try:
+                    websocket.raw_write(queue.popleft())
+                except socket.error:
+                    self.metrics.increment('websocket_send_failures_total')
+                    self.close()
+            if self.close_status is not None and not self.closed:
+                try:
+                    websocket.close(*self.close_status)
+                except socket.error:
+                    pass
+                self.disconnect()
+
+    def close(self):
+        """Stop writing to the websocket, discarding the queued frames.
+        """
+        self.closed = True
+        self.queue.clear()
+        self._has_messages.set()  # wake up the writer to let it exit
+
+    def shutdown(self, code=1000, reason=''):
+        """Close the websocket with the given close code and reason once the queued frames are
+        written, then close the connection, which makes the receiving side exit.
+        """
+        if not self.closed:
+            self.close_status = (code, reason)
+            self._has_messages.set()
+
+    def disconnect(self):
+        """Close the connection without the closing handshake, which a stuck client wouldn't
+        complete. The receiving side of the websocket notices it and exits.
+        """
+        self.close()
+        try:
+            self.websocket.handler.socket.shutdown(socket.SHUT_RDWR)
+        except (AttributeError, socket.error):
+            pass
+
+
+class ChannelSubscription(object):
+    """Subscription of a multiplexed connection to a channel, or to all its sub-channels if
+    `prefix`. It is registered on the channel in place of a websocket.
+    """
+    __slots__ = ('connection', 'channel', 'prefix', 'channel_sockets', 'frame_type',
+                 'attributes')
+
+    def __init__(self, connection, channel, prefix=False):
+        self.connection = connection
+        self.channel = channel
+        self.prefix = prefix
+        self.channel_sockets = None  # the ChannelSockets node it is registered on
+        self.frame_type = connection.frame_type
+        self.attributes = connection.attributes
+
+    def send_frame(self, frame):
+        connection = self.connection
+        if frame is connection.last_multiplexed_frame:
+            return True  # the message matches several subscriptions of the connection
+        connection.last_multiplexed_frame = frame
+        return connection.send_frame(frame)
+
+
+class Heartbeats(object):
+    """Pings the websockets the clients have sent nothing on for `interval` seconds, and
+    disconnects those which don't answer within `timeout` seconds, so dead peers are noticed on
+    quiet channels too and their websockets removed. The checks are scheduled on one
+    `TimerWheel`; receiving a frame doesn't touch it, the time of the last one is compared when
+    the timer of a connection fires.
+    """
+    PING_FRAME = geventwebsocket.websocket.Header.encode_header(
+        True, geventwebsocket.websocket.WebSocket.OPCODE_PING, '', 0, 0)
+
+    def __init__(self, interval=30.0, timeout=10.0, tick=1.0):
+        """
+        Args:
+            interval (float): seconds of silence after which a client is pinged
+            timeout (float): seconds to wait for the pong, or any other frame
+            tick (float): precision of the timers, see `TimerWheel`
+        """
+        self.interval = interval
+        self.timeout = timeout
+        self.wheel = TimerWheel(self._check, tick,
+                                slot_count=int(math.ceil(max(interval, timeout) / tick)) + 1)
+        self.metrics = Metrics(enabled=False)
+        self.reaped_count = 0
+
+    def start(self, metrics=None):
+        if metrics is not None:
+            self.metrics = metrics
+        self.wheel.start()
+
+    def add(self, connection):
+        """Start checking a `WebSocketConnection`.
+        """
+        self.wheel.schedule(connection, self.interval)
+
+    def discard(self, connection):
+        self.wheel.cancel(connection)
+
+    def _check(self, connection):
+        """Ping a connection which has been silent for `interval`, or disconnect it if it
+        hasn't answered the ping.
+        """
+        if connection.closed:
+            return
+        now = time.time()
+        received_at = connection.received_at
+        if connection.ping_sent_at is None:
+            silent_for = now - received_at
+            if silent_for < self.interval:
+                self.wheel.schedule(connection, self.interval - silent_for)
+                return
+            connection.ping_sent_at = now
+            connection.send_frames([self.PING_FRAME], first=True)
+            self.metrics.increment('websocket_pings_sent_total')
+            self.wheel.schedule(connection, self.timeout)
+        elif received_at >= connection.ping_sent_at:
+            connection.ping_sent_at = None
+            self.wheel.schedule(connection, self.interval - (now - received_at))
+        else:
+            logger.info('Disconnecting unresponsive client on channel `%s`', connection.channel)
+            self.reaped_count += 1
+            self.metrics.increment('websocket_connections_reaped_total')
+            connection.disconnect()
+
+    def close(self):
+        self.wheel.close()
 
 
 class ChannelSockets(object):
-    """Channels and WebSockets registered on them.
+    """Channels and WebSockets registered on them. A node exists only while there are websockets
+    registered on it or on its sub-channels; the sets of websockets and the sub-channels are
+    created on first use.
+
+    Each node also indexes the websockets registered on all its sub-channels, at any depth, so a
+    message can be sent to a whole subtree without walking it. Registering and unregistering a
+    websocket costs O(depth) instead.
+
+    Websockets may also be registered on all the sub-channels of a node at once (prefix
+    subscriptions of multiplexed connections); they are indexed in the ancestors as if they were
+    registered on a sub-channel.
+
+    A node with a message history (see `MessageHistory`) is kept until the history is dropped.
     """
-    def __init__(self, name):
-        self.name = name
-        self.websockets = set()
-        self._subchannels = {}
+    __slots__ = ('key', 'parent', 'websockets', 'prefix_websockets', 'descendant_websockets',
+                 'history', '_subchannels')
+
+    def __init__(self, key, parent=None):
+        self.key = key  # name of the channel relative to the parent
+        self.parent = parent
+        self.websockets = ()  # websockets on this channel
+        self.prefix_websockets = ()  # websockets on all the sub-channels
+        self.descendant_websockets = ()  # websockets on the sub-channels
+        self.history = None  # recent messages, see `MessageHistory`
+        self._subchannels = None
+
+    @property
+    def name(self):
+        """Full channel name.
+        """
+        if self.parent is None:
+            return self.key
+        return self.parent.name + '/' + self.key
 
     def __getitem__(self, name):
-        """Get a sub-channel.
+        """Get a sub-channel, creating it if needed.
         """
+        if self._subchannels is None:
+            self._subchannels = {}
         channel = self._subchannels.get(name)
         if channel is None:
-            channel = self.__class__(self.name + '/' + name)
+            channel = self.__class__(name, self)
             self._subchannels[name] = channel
         return channel
 
+    def get(self, name):
+        """Get a sub-channel or None if it doesn't exist.
+        """
+        if self._subchannels is None:
+            return None
+        return self._subchannels.get(name)
+
+    def find(self, names, closest=False):
+        """Get a nested sub-channel by the names of the channels on the path to it, or None if it
+        doesn't exist (its closest existing ancestor if `closest`). Nothing is created.
+        """
+        channel = self
+        for name in names:
+            subchannel = channel.get(name)
+            if subchannel is None:
+                return channel if closest else None
+            channel = subchannel
+        return channel
+
     def __iter__(self):
+        if self._subchannels is None:
+            return iter(())
         return self._subchannels.itervalues()
 
+    def add(self, websocket, prefix=False):
+        """Register a websocket on this channel, or on all its sub-channels if `prefix`.
+        """
+        if prefix:
+            if not self.prefix_websockets:
+                self.prefix_websockets = set()
+            self.prefix_websockets.add(websocket)
+        else:
+            if not self.websockets:
+                self.websockets = set()
+            self.websockets.add(websocket)
+        channel = self.parent
+        while channel is not None:
+            if not channel.descendant_websockets:
+                channel.descendant_websockets = set()
+            channel.descendant_websockets.add(websocket)
+            channel = channel.parent
+
+    def discard(self, websocket, prefix=False):
+        """Unregister a websocket from this channel (from all its sub-channels if `prefix`) and
+        remove the channels left empty.
+        """
+        if prefix:
+            if websocket not in self.prefix_websockets:
+                return
+            self.prefix_websockets.remove(websocket)
+            if not self.prefix_websockets:
+                self.prefix_websockets = ()
+        else:
+            if websocket not in self.websockets:
+                return
+            self.websockets.remove(websocket)
+            if not self.websockets:
+                self.websockets = ()
+        channel = self.parent
+        while channel is not None:
+            channel.descendant_websockets.discard(websocket)
+            if not channel.descendant_websockets:
+                channel.descendant_websockets = ()
+            channel = channel.parent
+        self.prune()
+
+    def prune(self):
+        """Remove this channel and its ancestors which have neither websockets, nor sub-channels,
+        nor history.
+        """
+        channel = self
+        while (channel.parent is not None and not channel.websockets and not channel._subchannels
+               and not channel.prefix_websockets and channel.history is None):
+            parent = channel.parent
+            del parent._subchannels[channel.key]
+            if not parent._subchannels:
+                parent._subchannels = None
+            channel.parent = None
+            channel = parent
+
+
+def encode_history_message(message_id, message):
+    """Return a message with its history id, as sent to clients which asked for the ids:
+    `{"id": "<id>", "message": "<message>"}`.
+    """
+    return json.dumps({'id': message_id, 'message': message})
+
+
+def encode_multiplexed_message(channel, message, message_id=None):
+    """Return a message tagged with the channel it was published on, as sent to multiplexed
+    connections: `{"channel": "<channel>", "message": "<message>"}`, with `"id"` if it has one.
+    """
+    data = {'channel': channel, 'message': message}
+    if message_id is not None:
+        data['id'] = message_id
+    return json.dumps(data)
+
+
+def encode_envelope(channel, message, message_id=None):
+    """Return a binary message in a msgpack envelope, as sent to clients which are sent
+    message ids or channels: `{"channel": <channel>, "id": <id or nil>, "message": <bytes>}`.
+    """
+    if isinstance(channel, str):
+        channel = channel.decode('utf-8')
+    if isinstance(message_id, str):
+        message_id = message_id.decode('utf-8')
+    if isinstance(message, memoryview):
+        message = message.tobytes()
+    return msgpack.packb({u'channel': channel, u'id': message_id, u'message': message},
+                         use_bin_type=True)
+
+
+class MessageHistory(object):
+    """Recent messages of channels, kept in memory so that a reconnecting client can be sent what
+    it missed. Every ChannelSockets node has a ring buffer of the messages published on its
+    channel and to its sub-channels (`a/`), evicted by count and age. After the last websocket of
+    a channel disconnects, the worker stays subscribed to it and keeps recording its messages for
+    `linger` seconds.
+
+    Ids are assigned by the worker when messages are delivered, so they can be resumed from only
+    in the same worker process; a client resuming from an unknown id is sent all the history.
+    `RedisStreamHistory` is shared by the workers.
+    """
+    ids_published = False  # whether the ids are assigned when publishing, see `publish`
+
+    def __init__(self, max_count=100, max_age=None, linger=60):
+        """
+        Args:
+            max_count (int): maximum number of messages kept per channel
+            max_age (float): number of seconds after which messages are evicted
+            linger (float): number of seconds the history of a channel is kept after its last
+                websocket disconnects
+        """
+        self.max_count = max_count
+        self.max_age = max_age
+        self.linger = linger
+        self.id_prefix = '%x.%x-' % (int(time.time()), os.getpid())  # unique for the process
+        self.last_number = 0
+
+    def publish(self, messages):
+        """Assign ids to (channel, message) pairs being published, if `ids_published`.
+
+        Returns:
+            iterable: the (channel, message) pairs to publish, with the ids in the messages
+        """
+        return messages
+
+    def add(self, channel_sockets, message, only_subchannels):
+        """Record a delivered message in the history of the ChannelSockets node of its channel.
+
+        Args:
+            channel_sockets (ChannelSockets): node of the channel; None if it doesn't exist, then
+                the message isn't recorded
+
+        Returns:
+            tuple: the id of the message (None if it isn't recorded) and the message
+        """
+        if channel_sockets is None:
+            return None, message
+        self.last_number += 1
+        history = channel_sockets.history
+        if history is None:
+            history = channel_sockets.history = collections.deque(maxlen=self.max_count)
+        now = time.time()
+        history.append((self.last_number, now, only_subchannels, message))
+        self._evict(history, now)
+        return self.id_prefix + str(self.last_number), message
+
+    def _evict(self, history, now):
+        """Remove the messages older than `max_age` from a ring buffer.
+        """
+        if self.max_age is not None:
+            min_time = now - self.max_age
+            while history and history[0][1] < min_time:
+                history.popleft()
+
+    def get_since(self, channel, channel_sockets, since):
+        """Return the messages for a websocket on the given channel delivered after the message
+        with the given id: those published on the channel and to the sub-channels of its
+        ancestors.
+
+        Args:
+            channel (str): the channel
+            channel_sockets (ChannelSockets): node of the channel
+            since (str): id of the last message received by the client
+
+        Returns:
+            list: (id, message) pairs, the oldest first
+        """
+        number = 0
+        if since.startswith(self.id_prefix):
+            try:
+                number = int(since[len(self.id_prefix):])
+            except ValueError:
+                pass
+        now = time.time()
+        messages = []
+        node = channel_sockets
+        while node is not None:
+            if node.history:
+                self._evict(node.history, now)
+                subchannels = node is not channel_sockets
+                messages.extend(item for item in node.history
+                                if item[0] > number and item[2] == subchannels)
+            node = node.parent
+        messages.sort()
+        return [(self.id_prefix + str(item[0]), item[3]) for item in messages]
+
+
+class RedisStreamHistory(MessageHistory):
+    """Message history kept in Redis Streams (Redis 5.0+), one stream per channel, shared by all
+    the workers. Messages are added to the stream of their channel when they are published (by
+    the Redis brokers in their publishing batches), and the ids assigned by Redis travel with
+    them to the workers. Streams are trimmed approximately
+    to `max_count` messages and expire `max_age` seconds after the last message.
+    """
+    ids_published = True
+    STREAM_PREFIX = 'websocket-history:'
+    PIPELINE_SIZE = 100  # messages added to the streams in one round trip
+
+    def __init__(self, redis_url, max_count=100, max_age=None):
+        """
+        Args:
+            redis_url (str): URL of the Redis server
+            max_count, max_age: see `MessageHistory`
+        """
+        super(RedisStreamHistory, self).__init__(max_count, max_age, linger=0)
+        self.redis_client = redis.from_url(redis_url)
+
+    def publish(self, messages):
+        """Add the messages to the streams of their channels in pipelines and prefix them with
+        their ids. A message which couldn't be added is published without an id. The messages
+        of `Presence` aren't kept, they are published as they are.
+        """
+        messages = iter(messages)
+        while True:
+            batch = list(itertools.islice(messages, self.PIPELINE_SIZE))
+            if not batch:
+                break
+            kept = [(channel, message) for channel, message in batch
+                    if channel != Presence.CHANNEL]
+            if len(kept) < len(batch):
+                for channel, message in batch:
+                    if channel == Presence.CHANNEL:
+                        yield channel, message
+                batch = kept
+                if not batch:
+                    continue
+            redis_pipeline = self.redis_client.pipeline(transaction=False)
+            for channel, message in batch:
+                key = self.STREAM_PREFIX + channel
+                redis_pipeline.execute_command('XADD', key, 'MAXLEN', '~', self.max_count, '*',
+                                               'message', message)
+                if self.max_age is not None:
+                    redis_pipeline.expire(key, int(math.ceil(self.max_age)))
+            try:
+                results = redis_pipeline.execute()
+            except redis.RedisError:
+                logger.exception('Failed to add %d messages to the history', len(batch))
+                results = [''] * len(batch) * (1 if self.max_age is None else 2)
+            message_ids = results if self.max_age is None else results[::2]
+            for (channel, message), message_id in zip(batch, message_ids):
+                yield channel, '%s %s' % (message_id, message)
+
+    def add(self, channel_sockets, message, only_subchannels):
+        message_id, _, message = message.partition(' ')
+        return message_id or None, message
+
+    def get_since(self, channel, channel_sockets, since):
+        start = self._parse_id(since)
+        if self.max_age is not None:
+            start = max(start, (int((time.time() - self.max_age) * 1000), 0))
+        messages = []
+        for stream_channel in get_subscription_channels(channel) + ['/']:
+            try:
+                entries = self.redis_client.execute_command(
+                    'XRANGE', self.STREAM_PREFIX + stream_channel, '%d-%d' % start, '+',
+                    'COUNT', self.max_count)
+            except redis.RedisError:
+                logger.warning('Failed to read the history of `%s`', stream_channel,
+                               exc_info=True)
+                continue
+            for message_id, fields in entries:
+                parsed_id = self._parse_id(message_id)
+                if parsed_id > start:  # XRANGE includes the start
+                    messages.append((parsed_id, message_id, dict(zip(fields[::2], fields[1::2]))))
+        messages.sort()
+        return [(message_id, fields.get('message', '')) for _, message_id, fields in messages]
+
+    def _parse_id(self, message_id):
+        """Return a stream id as a comparable tuple; (0, 0) if it's not a valid id.
+        """
+        milliseconds, _, sequence = message_id.partition('-')
+        try:
+            return int(milliseconds), int(sequence or 0)
+        except ValueError:
+            return 0, 0
+
+
+class Presence(object):
+    """Numbers of websockets on channels in all the workers, see `count`.
+
+    Every worker counts its own websockets per channel as they register and unregister, and
+    every `interval` seconds publishes the numbers which changed through the broker, on
+    `CHANNEL`. From these messages every worker keeps the numbers of all the workers and their
+    sums, so `count` is a dict lookup. A worker publishes at least every `interval` seconds, and
+    one not heard of for `timeout` seconds is considered gone; its websockets aren't counted
+    anymore. A worker hearing of a new one publishes all its numbers, for the new one to know
+    them.
+    """
+    CHANNEL = '__presence__'  # reserved for the messages of the workers
+    MESSAGE_MAX_CHANNELS = 500  # numbers are published in messages of at most this many channels
+
+    def __init__(self, interval=1.0, timeout=None, events=False):
+        """
+        Args:
+            interval (float): how often the changes are published, in seconds
+            timeout (float): number of seconds after which a silent worker is considered gone;
+                5 intervals by default
+            events (bool): whether the websockets on a channel are sent `{"presence": <count>}`
+                when the number of websockets on it changes, see `on_change`
+        """
+        self.interval = interval
+        self.timeout = 5 * interval if timeout is None else timeout
+        self.events = events
+        self.worker_id = '%s:%d' % (socket.gethostname(), os.getpid())
+        self.on_change = None  # called with a channel and its new count, if `events`
+        self.local_counts = collections.Counter()  # numbers of the websockets of this worker
+        self.counts = collections.Counter()  # numbers of the websockets of all the workers
+        self.workers = {}  # worker id -> time it was last heard of, {channel: count}
+        self._changed = set()  # channels whose local counts haven't been published yet
+        self._publisher = None
+
+    def start(self, broker):
+        """Start publishing the numbers of the websockets of this worker through the broker.
+        """
+        broker.subscribe([self.CHANNEL])
+        self._publisher = self._publish_counts(broker)
+
+    def add(self, channels, delta):
+        """Count websockets joining (`delta` > 0) or leaving a channel.
+
+        Args:
+            channels (list): the channel and the sub-channel broadcasts it's part of, see
+                `get_subscription_channels`
+        """
+        local_counts = self.local_counts
+        for channel in itertools.chain(channels, ('/',)):
+            local_counts[channel] += delta
+            if not local_counts[channel]:
+                del local_counts[channel]
+            self._changed.add(channel)
+
+    def count(self, channel):
+        """Return the number of websockets on the given channel in all the workers; with a
+        trailing slash, on all its sub-channels (`/` for all the websockets). The number is up
+        to date within about `interval` seconds.
+        """
+        return self.counts.get(channel, 0)
+
+    @async
+    def _publish_counts(self, broker):
+        """Publish the changed local counts every `interval` seconds, all of them when a new
+        worker appears, and forget the workers which are gone.
+        """
+        while True:
+            gevent.sleep(self.interval)
+            changed, self._changed = self._changed, set()
+            counts = [(channel, self.local_counts.get(channel, 0)) for channel in changed]
+            for start in xrange(0, max(1, len(counts)), self.MESSAGE_MAX_CHANNELS):
+                broker.publish(json.dumps({
+                    'worker': self.worker_id,
+                    'counts': dict(counts[start:start + self.MESSAGE_MAX_CHANNELS])}),
+                    self.CHANNEL)
+            now = time.time()
+            for worker_id, (heard_at, counts) in self.workers.items():
+                if now - heard_at > self.timeout:
+                    logger.info('Worker %s is gone, not counting its websockets', worker_id)
+                    del self.workers[worker_id]
+                    self._update(counts, dict.fromkeys(counts, 0))
+
+    def receive(self, message):
+        """Apply the numbers published by a worker. Malformed messages are logged and ignored.
+        """
+        try:
+            data = json.loads(message)
+            worker_id = data['worker']
+            counts = data['counts']
+            if (not isinstance(worker_id, basestring) or not isinstance(counts, dict) or
+                    not all(isinstance(count, (int, long)) for count in counts.itervalues())):
+                raise ValueError('Invalid worker or counts')
+        except (ValueError, TypeError, KeyError):
+            logger.warning('Ignoring malformed presence message: %r', message, exc_info=True)
+            return
+        worker = self.workers.get(worker_id)
+        if worker is None:
+            worker = self.workers[worker_id] = (time.time(), {})
+            if worker_id != self.worker_id:
+                self._changed.update(self.local_counts)  # publish all for the new worker
+        else:
+            worker = self.workers[worker_id] = (time.time(), worker[1])
+        self._update(worker[1], counts)
+
+    def _update(self, worker_counts, counts):
+        """Replace the numbers of a worker with the given ones and update the sums.
+        """
+        totals = self.counts
+        for channel, count in counts.iteritems():
+            delta = count - worker_counts.get(channel, 0)
+            if count:
+                worker_counts[channel] = count
+            else:
+                worker_counts.pop(channel, None)
+            if not delta:
+                continue
+            totals[channel] += delta
+            if not totals[channel]:
+                del totals[channel]
+            if self.events and self.on_change is not None:
+                self.on_change(channel, totals.get(channel, 0))
+
+    def close(self):
+        if self._publisher is not None:
+            self._publisher.kill()
+            self._publisher = None
+
+
+class AdmissionControl(object):
+    """Decides whether a websocket may connect before the handshake, so unwanted and excess
+    connections are rejected with a cheap HTTP response, before a connection is created and
+    registered on its channel. Admitted websockets are counted until they are released.
+    """
+    ADMITTED_KEY = 'websocket_channels.admitted_address'  # environ key of admitted websockets
+
+    def __init__(self, max_connections=None, max_connections_per_ip=None, channel_patterns=None,
+                 authenticate=None, ip_header=None, retry_after=5):
+        """
+        Args:
+            max_connections (int): maximum number of websockets of the worker; `Worker` derives
+                it from `worker_connections` if it is not given
+            max_connections_per_ip (int): maximum number of websockets from one address
+            channel_patterns (list): regular expressions, one of which a channel must match
+                entirely, e.g. `r'chat/\w+'`
+            authenticate (callable): called with the token sent by the client (the `token`
+                query parameter or the `Authorization: Bearer` header, None if there is none)
+                and the channel; returns whether the client may connect
+            ip_header (str): header with the address of the client set by a proxy, e.g.
+                `X-Real-IP`; the address of the peer is used by default
+            retry_after (int): number of seconds after which clients rejected because the worker
+                is full should retry
+        """
+        self.max_connections = max_connections
+        self.max_connections_per_ip = max_connections_per_ip
+        self.channel_patterns = [re.compile(r'(?:%s)\Z' % pattern)
+                                 for pattern in channel_patterns or ()]
+        self.authenticate = authenticate
+        self.ip_environ_key = ip_header and 'HTTP_' + ip_header.upper().replace('-', '_')
+        self.retry_after = retry_after
+        self.connection_count = 0
+        self.ip_counts = collections.Counter()
+
+    def admit(self, environ, channel):
+        """Check whether a websocket may connect to the given channel (None for a multiplexed
+        connection), counting it if it may.
+
+        Returns:
+            tuple: None if the websocket is admitted, otherwise the reason (used in metrics),
+                the HTTP status and headers of the response
+        """
+        if self.max_connections is not None and self.connection_count >= self.max_connections:
+            return 'capacity', '503 Service Unavailable', [('Retry-After', str(self.retry_after))]
+        address = self._get_address(environ)
+        if (self.max_connections_per_ip is not None
+                and self.ip_counts[address] >= self.max_connections_per_ip):
+            return 'ip_limit', '429 Too Many Requests', []
+        if channel is not None:
+            rejection = self.check_channel(environ, channel)
+            if rejection is not None:
+                return rejection
+        self.connection_count += 1
+        self.ip_counts[address] += 1
+        environ[self.ADMITTED_KEY] = address
+        return None
+
+    def check_channel(self, environ, channel):
+        """Check whether the client may use the given channel: whether it matches the channel
+        patterns and the client is authenticated for it.
+
+        Returns:
+            tuple: None if it may, otherwise the reason, the HTTP status and headers
+        """
+        if self.channel_patterns and not any(
+                pattern.match(channel) for pattern in self.channel_patterns):
+            return 'channel', '404 Not Found', []
+        if self.authenticate is not None and not self.authenticate(
+                self._get_token(environ), channel):
+            return 'auth', '403 Forbidden', []
+        return None
+
+    def release(self, environ):
+        """Stop counting a websocket admitted with the given environ, e.g. when it disconnects.
+        """
+        address = environ.pop(self.ADMITTED_KEY, None)
+        if address is None:
+            return
+        self.connection_count -= 1
+        self.ip_counts[address] -= 1
+        if self.ip_counts[address] <= 0:
+            del self.ip_counts[address]
+
+    def _get_address(self, environ):
+        if self.ip_environ_key:
+            address = environ.get(self.ip_environ_key)
+            if address:  # the last one is added by the nearest proxy, which is trusted
+                return address.rsplit(',', 1)[-1].strip()
+        return environ.get('REMOTE_ADDR')
+
+    def _get_token(self, environ):
+        token = urlparse.parse_qs(environ.get('QUERY_STRING', '')).get('token')
+        if token:
+            return token[0]
+        authorization = environ.get('HTTP_AUTHORIZATION', '')
+        if authorization.lower().startswith('bearer '):
+            return authorization[7:].strip()
+        return None
+
+
+class MessagePipeline(object):
+    """Transforms and filters of the messages sent to websockets, registered on channels. Those
+    of a channel apply to the messages published on it and on its sub-channels, broadcasts to
+    sub-channels included; those of `/` to all the messages. They run in the order of the
+    channels from the root, then in the order they were added, and are compiled once per
+    channel into a list, so a message costs one dict lookup when none apply.
+
+    A transform is called once per message in each worker, with the channel and the message
+    (binary ones start with `BINARY_PREFIX`), and returns the message to send, or None to drop
+    it. The transformed message is what is kept in a `MessageHistory`; messages replayed from a
+    history keeping them as published (`RedisStreamHistory`) are transformed when replayed.
+
+    A filter is also called once per message, with the channel and the message, and returns
+    None to send it to all the websockets, or a predicate called with the `attributes` of each
+    websocket, returning whether to send it the message. The attributes are computed by
+    `get_attributes` once, when the websocket connects, so selecting the recipients costs one
+    call per websocket.
+
+    A message on which a transform or a filter raises an exception is dropped, a websocket on
+    which a predicate raises one isn't sent the message; the errors are logged and counted.
+    """
+    CACHE_SIZE = 10000  # channels whose compiled stages are kept
+
+    def __init__(self, get_attributes=None):
+        """
+        Args:
+            get_attributes (callable): called with the WSGI environment of a websocket, returns
+                the attributes (dict) passed to the predicates of the filters, e.g. the user
+                authenticated by the token of the request; `{}` by default
+        """
+        self.get_attributes = get_attributes or (lambda environ: {})
+        self._stages = collections.defaultdict(list)  # channel -> [(is_filter, function)]
+        self._compiled = {}  # channel -> [(is_filter, function)] of the channel and ancestors
+
+    def add_transform(self, channel, transform):
+        """Transform the messages of the given channel and its sub-channels, see the class.
+        """
+        self._add(channel, False, transform)
+
+    def add_filter(self, channel, filter):
+        """Filter the recipients of the messages of the given channel and its sub-channels,
+        see the class.
+        """
+        self._add(channel, True, filter)
+
+    def _add(self, channel, is_filter, function):
+        self._stages[channel.strip('/')].append((is_filter, function))
+        self._compiled.clear()
+
+    def _compile(self, channel):
+        """Return the stages applying to the messages of the given channel.
+        """
+        names = [name for name in channel.split('/') if name]
+        stages = []
+        for depth in xrange(len(names) + 1):
+            stages.extend(self._stages.get('/'.join(names[:depth]), ()))
+        if len(self._compiled) >= self.CACHE_SIZE:
+            self._compiled.popitem()
+        self._compiled[channel] = stages
+        return stages
+
+    def process(self, channel, message, transform=True):
+        """Run the stages of the given channel on a message.
+
+        Args:
+            transform (bool): whether to run the transforms, or only the filters
+
+        Returns:
+            tuple: the message to send, or None if it is dropped, and the predicate selecting
+                the websockets to send it to, or None for all of them
+        """
+        stages = self._compiled.get(channel)
+        if stages is None:
+            stages = self._compile(channel)
+        predicates = []
+        for is_filter, function in stages:
+            if is_filter:
+                predicate = function(channel, message)
+                if predicate is not None:
+                    predicates.append(predicate)
+            elif transform:
+                message = function(channel, message)
+                if message is None:
+                    return None, None
+        if not predicates:
+            return message, None
+        if len(predicates) == 1:
+            return message, predicates[0]
+        return message, lambda attributes: all(predicate(attributes) for predicate in predicates)
+
 
 class WebSocketChannelMiddleware(object):
     """WSGI middleware around a WSGI application which expects `wsgi.websocket` request
     environment value provided by a Gunicorn worker and handles that websocket.
     """
-    REDIS_CHANNEL_PREFIX = 'websocket:'
-
-    def __init__(self, wsgi_app, redis_url):
+    def __init__(self, wsgi_app, redis_url=None, broker=None, inbound_rate=None,
+                 inbound_burst=None, send_queue_size=100,
+                 send_queue_overflow_policy=WebSocketConnection.DROP_OLDEST, metrics=None,
+                 stats_path=None, admission=None, deflate=True, deflate_min_size=512,
+                 history=None, multiplex_path=None, max_subscriptions=100,
+                 channel_cache_size=10000, presence=None, envelope=None, pipeline=None,
+                 heartbeats=None):
+        """
+        Args:
+            wsgi_app: the wrapped WSGI application
+            redis_url (str|list): URL of the Redis server used for Pub/Sub, if `broker` is not
+                given, or URLs of several servers for a `ShardedRedisBroker`
+            broker (Broker): how published messages reach the workers; a `RedisBroker` by
+                default
+            inbound_rate (float): if given, maximum average number of messages per second
+                received from a single websocket; reading from a faster client is paused
+            inbound_burst (int): how many messages a client may send at once above
+                `inbound_rate`
+            send_queue_size, send_queue_overflow_policy: options of the outbound queue of each
+                `WebSocketConnection`
+            metrics (Metrics): where to record the metrics; enabled, not shared between
+                workers by default
+            stats_path (str): if given, path on which the metrics are exported in the
+                Prometheus text format, e.g. `/ws-stats`
+            admission (AdmissionControl): decides which websockets may connect; only the
+                capacity of the worker is limited by default (with `Worker`)
+            deflate (bool): whether to negotiate permessage-deflate with clients offering it;
+                a client can opt out with the `deflate=0` query parameter
+            deflate_min_size (int): minimum size of a message to be compressed; a message is
+                compressed once for all the websockets which negotiated the extension
+            history (MessageHistory): if given, recent messages of the channels are kept, and a
+                client connecting with the `since=<id>` query parameter is sent the messages
+                after that id first; the messages are then sent to it with their ids (see
+                `encode_history_message`), `since=` asks only for the ids
+            multiplex_path (str): if given, path of websockets subscribing to any number of
+                channels with control messages, e.g. `/ws-mux` (see
+                `_handle_multiplexed_connection`)
+            max_subscriptions (int): maximum number of channels a multiplexed websocket may be
+                subscribed to
+            channel_cache_size (int): maximum number of channels whose nodes are cached by name
+                for delivering messages
+            presence (Presence): if given, the numbers of websockets on the channels in all the
+                workers are kept; the channel `Presence.CHANNEL` is reserved for it
+            envelope (str): how binary messages are sent to clients which are sent message ids
+                or channels, which are in JSON for text messages: `'msgpack'` for
+                `encode_envelope`; by default such clients are sent just the binary payload
+            pipeline (MessagePipeline): if given, transforms the delivered messages and selects
+                the websockets they are sent to
+            heartbeats (Heartbeats): if given, silent clients are pinged and those not
+                answering are disconnected
+        """
+        if envelope not in (None, 'msgpack'):
+            raise ValueError('Unknown envelope: %r' % envelope)
+        if envelope == 'msgpack' and msgpack is None:
+            raise ValueError('The msgpack envelope needs the `msgpack` package')
+        if broker is None:
+            if redis_url is None:
+                raise ValueError('Either `redis_url` or `broker` must be given')
+            elif isinstance(redis_url, (list, tuple)):
+                broker = ShardedRedisBroker(redis_url)
+            else:
+                broker = RedisBroker(redis_url)
         self.wsgi_app = wsgi_app
-        self.redis_client = redis.from_url(redis_url)
-        self.pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+        self.broker = broker
+        self.inbound_rate = inbound_rate
+        self.inbound_burst = inbound_burst
+        self.send_queue_size = send_queue_size
+        self.send_queue_overflow_policy = send_queue_overflow_policy
         self.channel_sockets = ChannelSockets('')
-        self._listen()
+        self.channel_cache_size = channel_cache_size
+        self._channel_cache = {}  # channel name -> ChannelSockets, see `_find_channel_sockets`
+        self._frame_type_counts = [0] * 6  # registered connections by `frame_type`
+        self.connections = set()
+        self.metrics = Metrics() if metrics is None else metrics
+        self.stats_path = stats_path
+        self.admission = AdmissionControl() if admission is None else admission
+        self.deflate = deflate
+        self.deflate_min_size = deflate_min_size
+        self.history = history
+        self.multiplex_path = multiplex_path
+        self.max_subscriptions = max_subscriptions
+        self.prefix_subscription_count = 0  # sub-channels are searched for them if there are any
+        self.draining = False  # whether new websockets are rejected, see `drain`
+        self.presence = presence
+        self.envelope = envelope
+        self.pipeline = pipeline
+        self.heartbeats = heartbeats
+        self._lingering = collections.Counter()  # ChannelSockets -> channels lingering in it
+        # the history assigning the ids of published messages, unless the broker does it
+        self._publishing_history = None
+        if (history is not None and history.ids_published and
+                not self.broker.set_history(history)):
+            self._publishing_history = history
+        self.metrics.collect = self._update_gauges
+        self.broker.start(self._deliver_messages, self.metrics)
+        if presence is not None:
+            presence.on_change = self._send_presence
+            presence.start(self.broker)
+        if heartbeats is not None:
+            heartbeats.start(self.metrics)
 
     def __call__(self, environ, start_response):
         path = environ['PATH_INFO']
         if path.startswith('/ws/'):
             channel = path[4:].rstrip('/')
             websocket = environ['wsgi.websocket']
-            self._handle_websocket_connection(websocket, channel)
+            since = None
+            if self.history is not None:
+                since = urlparse.parse_qs(environ.get('QUERY_STRING', ''),
+                                          keep_blank_values=True).get('since', [None])[0]
+            try:
+                self._handle_websocket_connection(websocket, channel, since, environ)
+            finally:
+                self.release_websocket(environ)
+        elif path == self.multiplex_path:
+            try:
+                self._handle_multiplexed_connection(environ['wsgi.websocket'], environ)
+            finally:
+                self.release_websocket(environ)
+        elif path == self.stats_path:
+            start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4')])
+            return [self.export_metrics().encode('utf-8')]
         else:  # call the wrapped app
             return self.wsgi_app(environ, start_response)
 
-    def _handle_websocket_connection(self, websocket, channel):
-        """Receive messages from a websocket.
+    def admit_websocket(self, environ):
+        """Hook called by `WebSocketHandler` before the handshake of a websocket, to reject it
+        cheaply if it isn't allowed or the worker is full. An admitted websocket must be released
+        by `release_websocket`.
+
+        Returns:
+            tuple: None if the websocket may connect, otherwise the HTTP status, headers and body
+                of the response
+        """
+        path = environ['PATH_INFO']
+        if path.startswith('/ws/'):
+            channel = path[4:].rstrip('/')
+        elif path == self.multiplex_path:
+            channel = None  # its channels are checked when it subscribes
+        else:
+            return None  # not ours
+        if self.draining:
+            rejection = 'draining', '503 Service Unavailable', [('Retry-After', '1')]
+        elif self.presence is not None and channel == Presence.CHANNEL:
+            rejection = 'channel', '404 Not Found', []
+        else:
+            rejection = self.admission.admit(environ, channel)
+        if rejection is None:
+            return None
+        reason, status, headers = rejection
+        self.metrics.increment(
+            format_sample_name('websocket_handshakes_rejected_total', {'reason': reason}))
+        return status, [('Content-Type', 'text/plain')] + headers, status
+
+    def release_websocket(self, environ):
+        """Hook called when a websocket admitted by `admit_websocket` is gone.
+        """
+        self.admission.release(environ)
+
+    def accept_deflate(self, environ):
+        """Hook called by `WebSocketHandler` when a client offers permessage-deflate.
+
+        Returns:
+            bool: whether messages to the websocket are to be compressed
         """
-        self._register_websocket(websocket, channel)
+        return (self.deflate and
+                urlparse.parse_qs(environ.get('QUERY_STRING', '')).get('deflate') != ['0'])
+
+    def _handle_websocket_connection(self, websocket, channel, since=None, environ=None):
+        """Receive messages from a websocket. Reading blocks cooperatively, so other greenlets
+        run while the client is silent.
+
+        Args:
+            since (str): if given, the client is sent message ids, and the messages from the
+                history after this id, unless it's empty
+            environ (dict): the WSGI environment of the websocket
+        """
+        connection = WebSocketConnection(websocket, channel, self.send_queue_size,
+                                         self.send_queue_overflow_policy, self.metrics,
+                                         with_ids=since is not None)
+        if self.pipeline is not None and environ is not None:
+            connection.attributes = self.pipeline.get_attributes(environ)
+        self._add_connection(connection)
+        self._register_websocket(connection, channel)
+        try:
+            if since:
+                self._replay_history(connection, since)
+            for message in self._receive_messages(websocket):
+                self.on_message(message, channel)
+        finally:
+            self._discard_connection(connection)
+            self._unregister_websocket(connection)
+            connection.close()
+
+    def _add_connection(self, connection):
+        self.connections.add(connection)
+        if self.heartbeats is not None:
+            self.heartbeats.add(connection)
+
+    def _discard_connection(self, connection):
+        self.connections.discard(connection)
+        if self.heartbeats is not None:
+            self.heartbeats.discard(connection)
+
+    def _handle_multiplexed_connection(self, websocket, environ):
+        """Receive control messages from a multiplexed websocket, which is sent the messages of
+        all the channels it subscribes to, tagged with their channels (see
+        `encode_multiplexed_message`):
+
+        - `{"subscribe": ["<channel>", ...]}`, optionally with `"since": "<id>"` to be sent the
+          messages after that id from the history, as with `/ws/<channel>?since=<id>`; a channel
+          ending with `/` stands for all its sub-channels
+        - `{"unsubscribe": ["<channel>", ...]}`
+        - `{"publish": "<channel>", "message": "<message>"}`, on a subscribed channel
+
+        Each channel is acknowledged with `{"subscribed": "<channel>"}`,
+        `{"unsubscribed": "<channel>"}` or `{"error": "<reason>", "channel": "<channel>"}`.
+        """
+        connection = WebSocketConnection(websocket, None, self.send_queue_size,
+                                         self.send_queue_overflow_policy, self.metrics,
+                                         multiplexed=True)
+        if self.pipeline is not None:
+            connection.attributes = self.pipeline.get_attributes(environ)
+        self._add_connection(connection)
+        try:
+            for message in self._receive_messages(websocket):
+                self._handle_control_message(connection, environ, message)
+        finally:
+            self._discard_connection(connection)
+            for subscription in connection.subscriptions.values():
+                self._unregister_websocket(subscription)
+            connection.subscriptions.clear()
+            connection.close()
+
+    def drain(self, window=10.0, code=1012):
+        """Close all the websockets of this worker, e.g. before it exits, so the clients
+        reconnect to the other workers. New websockets are rejected. The websockets are closed
+        one by one over `window` seconds, each after the messages queued for it are sent, with
+        close code 1012 (service restart) and the reason `{"retry_after": <seconds>}`: a random
+        delay within the window, for the clients to reconnect after, so they don't all
+        reconnect at once.
+
+        Args:
+            window (float): number of seconds to spread the closing over
+            code (int): the close code
+        """
+        self.draining = True
+        connections = [connection for connection in self.connections if not connection.closed]
+        random.shuffle(connections)
+        total = len(connections)
+        logger.info('Draining %d websockets in %.1f seconds', total, window)
+        started_at = time.time()
+        reported_count = 0
+        for number, connection in enumerate(connections):
+            gevent.sleep(max(0, started_at + window * number / total - time.time()))
+            retry_after = round(random.uniform(0, window), 1)
+            connection.shutdown(code, json.dumps({'retry_after': retry_after}))
+            self.metrics.increment('websocket_drained_total')
+            if number + 1 - reported_count >= total / 10.0 or number + 1 == total:  # every 10%
+                reported_count = number + 1
+                logger.info('Drained %d of %d websockets', reported_count, total)
+
+    def _receive_messages(self, websocket):
+        """Yield the messages received from a websocket until it's closed. Reading blocks
+        cooperatively, so other greenlets run while the client is silent.
+        """
+        rate_limiter = None
+        if self.inbound_rate:
+            rate_limiter = TokenBucket(self.inbound_rate, self.inbound_burst)
         while True:
-            gevent.sleep(0.05)  # switch to send messages
             try:
                 message = websocket.receive()
             except geventwebsocket.WebSocketError:
-                break
-            if message:
-                self.on_message(message, channel)
+                return
+            if not message:
+                if websocket.closed:
+                    return
+                continue
+            if rate_limiter is not None:
+                delay = rate_limiter.consume()
+                if delay:
+                    # not reading from the socket makes TCP flow control slow down the client
+                    gevent.sleep(delay)
+            self.metrics.increment('websocket_messages_received_total')
+            yield message
+
+    def _handle_control_message(self, connection, environ, message):
+        """Subscribe a multiplexed connection to channels, unsubscribe it or publish a message
+        from it, see `_handle_multiplexed_connection`. Binary messages are published if they
+        are in an envelope, see `encode_envelope`. Channels are encoded to UTF-8, as the channels
+        of the websocket paths and of the messages delivered by the brokers are.
+        """
+        control = None
+        if not isinstance(message, bytearray):
+            try:
+                control = json.loads(message)
+            except ValueError:
+                pass
+        elif self.envelope is not None:
+            try:
+                envelope = msgpack.unpackb(str(message))
+            except Exception:
+                envelope = None
+            if isinstance(envelope, dict) and isinstance(envelope.get('message'), str):
+                control = {'publish': envelope.get('channel'),
+                           'message': memoryview(envelope['message'])}
+        if not isinstance(control, dict) or not self._is_valid_control(control):
+            self._send_control_reply(connection, error='invalid')
+            return
+        if 'publish' in control:
+            channel = control['publish']
+            message = control.get('message')
+            if (not isinstance(channel, basestring) or
+                    not isinstance(message, (basestring, memoryview))):
+                self._send_control_reply(connection, error='invalid', channel=channel)
+            else:
+                if isinstance(channel, unicode):
+                    channel = channel.encode('utf-8')
+                if (channel, False) not in connection.subscriptions:
+                    self._send_control_reply(connection, error='not_subscribed', channel=channel)
+                else:
+                    self.on_message(message, channel)
+        for action in ('subscribe', 'unsubscribe'):
+            channels = control.get(action, ())
+            if isinstance(channels, basestring):
+                channels = [channels]
+            for channel in channels:
+                if not channel.strip('/'):
+                    self._send_control_reply(connection, error='invalid', channel=channel)
+                    continue
+                if isinstance(channel, unicode):
+                    channel = channel.encode('utf-8')
+                if action == 'subscribe':
+                    self._subscribe(connection, environ, channel, control.get('since'))
+                else:
+                    self._unsubscribe(connection, channel)
+
+    @staticmethod
+    def _is_valid_control(control):
+        """Return whether the channels to subscribe to and unsubscribe from are strings or lists
+        of strings, and `since` a string or null.
+        """
+        for action in ('subscribe', 'unsubscribe'):
+            channels = control.get(action, ())
+            if not isinstance(channels, basestring) and (
+                    not isinstance(channels, (list, tuple)) or
+                    not all(isinstance(channel, basestring) for channel in channels)):
+                return False
+        since = control.get('since')
+        return since is None or isinstance(since, basestring)
+
+    def _send_control_reply(self, connection, **reply):
+        connection.send_frames([encode_frame(json.dumps(reply))])
+
+    def _subscribe(self, connection, environ, channel, since=None):
+        """Subscribe a multiplexed connection to a channel, or to all its sub-channels if the
+        channel ends with `/`, and acknowledge it.
+        """
+        key = (channel.strip('/'), channel.endswith('/'))
+        if key in connection.subscriptions:
+            self._send_control_reply(connection, subscribed=channel)
+            return
+        if len(connection.subscriptions) >= self.max_subscriptions:
+            self._send_control_reply(connection, error='subscription_limit', channel=channel)
+            return
+        if self.presence is not None and key[0] == Presence.CHANNEL:
+            rejection = 'channel', '404 Not Found', []
+        else:
+            rejection = self.admission.check_channel(environ, key[0])
+        if rejection is not None:
+            self.metrics.increment(format_sample_name(
+                'websocket_subscriptions_rejected_total', {'reason': rejection[0]}))
+            self._send_control_reply(connection, error=rejection[0], channel=channel)
+            return
+        subscription = ChannelSubscription(connection, *key)
+        connection.subscriptions[key] = subscription
+        self._register_websocket(subscription, subscription.channel)
+        self._send_control_reply(connection, subscribed=channel)
+        if since and not subscription.prefix and self.history is not None:
+            self._replay_history(subscription, since)
+
+    def _unsubscribe(self, connection, channel):
+        """Unsubscribe a multiplexed connection from a channel and acknowledge it.
+        """
+        subscription = connection.subscriptions.pop(
+            (channel.strip('/'), channel.endswith('/')), None)
+        if subscription is None:
+            self._send_control_reply(connection, error='not_subscribed', channel=channel)
+            return
+        self._unregister_websocket(subscription)
+        self._send_control_reply(connection, unsubscribed=channel)
 
-    def _register_websocket(self, websocket, channel):
-        """Register a websocket so it can be sent published messages.
+    def _register_websocket(self, connection, channel):
+        """Register a websocket connection (or a `ChannelSubscription`) so it can be sent
+        published messages.
         """
         sockets = self.channel_sockets
         for channel in channel.split('/'):
             sockets = sockets[channel]
-        sockets.websockets.add(websocket)
+        sockets.add(connection, connection.prefix)
+        connection.channel_sockets = sockets
+        self._frame_type_counts[connection.frame_type] += 1
+        channels = get_subscription_channels(connection.channel, connection.prefix)
+        if connection.prefix:
+            self.prefix_subscription_count += 1
+        elif self.presence is not None:
+            self.presence.add(channels, 1)
+        self.broker.subscribe(channels)
+
+    def _unregister_websocket(self, connection):
+        """Unregister a closed websocket connection, removing the channels left empty. With an
+        in-memory history, the channel lingers: its messages are still received and recorded for
+        a while, for the client to reconnect.
+        """
+        channel_sockets = connection.channel_sockets
+        if channel_sockets is None:
+            return
+        connection.channel_sockets = None
+        self._frame_type_counts[connection.frame_type] -= 1
+        channels = get_subscription_channels(connection.channel, connection.prefix)
+        if self.presence is not None and not connection.prefix:
+            self.presence.add(channels, -1)
+        if self.history is not None and self.history.linger and not connection.prefix:
+            if channel_sockets.history is None:  # keeps the node
+                channel_sockets.history = collections.deque(maxlen=self.history.max_count)
+            node = channel_sockets
+            while node is not None:
+                self._lingering[node] += 1
+                node = node.parent
+            channel_sockets.discard(connection)
+            gevent.spawn_later(self.history.linger, self._stop_lingering, channel_sockets,
+                               channels)
+        else:
+            if connection.prefix:
+                self.prefix_subscription_count -= 1
+            channel_sockets.discard(connection, connection.prefix)
+            if self.history is not None:
+                self._drop_histories(channel_sockets)
+            self.broker.unsubscribe(channels)
+
+    def _stop_lingering(self, channel_sockets, channels):
+        """Stop receiving messages of a channel left by a websocket `linger` seconds ago and drop
+        the histories which no client can resume from anymore.
+        """
+        self.broker.unsubscribe(channels)
+        lingering = self._lingering
+        node = channel_sockets
+        while node is not None:
+            lingering[node] -= 1
+            if lingering[node] <= 0:
+                del lingering[node]
+                if (not node.websockets and not node.prefix_websockets
+                        and not node.descendant_websockets):
+                    node.history = None
+            node = node.parent
+        channel_sockets.prune()
+
+    def _drop_histories(self, channel_sockets):
+        """Drop the histories of a channel and of its ancestors which are left without websockets
+        and aren't lingering, removing the channels left empty.
+        """
+        node = channel_sockets
+        while node is not None:
+            if (node.history is not None and node not in self._lingering and not node.websockets
+                    and not node.prefix_websockets and not node.descendant_websockets):
+                node.history = None
+            node = node.parent
+        channel_sockets.prune()
+
+    def _replay_history(self, connection, since):
+        """Send a reconnected client the messages of its channel after the given id, before
+        the other messages (after those already queued for a multiplexed connection). A message
+        delivered while the history is being read may be sent twice. The messages are filtered
+        again by the pipeline, as if they were published on the channel of the client, and
+        transformed if the history keeps them as published (`ids_published`).
+        """
+        messages = self.history.get_since(connection.channel, connection.channel_sockets, since)
+        if self.pipeline is not None:
+            processed = [(message_id, self._process_history_message(connection, message))
+                         for message_id, message in messages]
+            messages = [(message_id, message) for message_id, message in processed
+                        if message is not None]
+        frames = [self._encode_frames(connection.channel, message, message_id)[
+            connection.frame_type] for message_id, message in messages]
+        first = True
+        if isinstance(connection, ChannelSubscription):
+            connection = connection.connection
+            first = False  # after the acknowledgement of the subscription
+        connection.send_frames(frames, first)
+        self.metrics.increment('websocket_history_replayed_total', len(messages))
+
+    def _process_history_message(self, connection, message):
+        """Return a message of the history as the pipeline lets it be sent to the given
+        connection, or None if it isn't sent to it.
+        """
+        try:
+            message, accept = self.pipeline.process(
+                connection.channel, message, transform=self.history.ids_published)
+            if message is None or accept is None or accept(connection.attributes):
+                return message
+            return None
+        except Exception:
+            logger.exception(u'The pipeline failed on a message of the history of `%s`',
+                             connection.channel)
+            self.metrics.increment('websocket_pipeline_errors_total')
+            return None
 
     def on_message(self, message, channel):
         """Hook called when a new message from a client via websocket arrives.
@@ -102,77 +2955,364 @@ class WebSocketChannelMiddleware(object):
         logic (e.g filtering).
 
         Args:
-            message (str): message to publish
+            message (str|bytearray|memoryview): message to publish, binary if the client sent
+                a binary message
             channel (str): on which channel
         """
         self.publish_message(message, channel)
 
-    @async
     def publish_message(self, message, channel):
-        """Asynchronously PUBLISH a message to the given Redis channel. SUBSCRIBEd Redis clients
-        will be notified about it.
+        """Asynchronously publish a message on the given channel through the broker. Workers
+        having websockets on the channel will send it to them.
 
         Args:
-            message (str): message to publish
-            channel (str): on which channel
+            message (str|bytearray|memoryview): message to publish; binary messages (see
+                `BINARY_TYPES`) are sent in binary frames
+            channel (str): on which channel; `Presence.CHANNEL` is reserved if `presence` is
+                given, publishing on it raises ValueError
         """
-        logger.info(u'Pusblishing message on channel `%s`: %s', channel, message)
-        self.redis_client.publish(self.REDIS_CHANNEL_PREFIX + channel, message)
+        self._check_published_channel(channel)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(u'Publishing message on channel `%s`: %r', channel, message)
+        self.metrics.increment('websocket_messages_published_total')
+        if isinstance(message, BINARY_TYPES):
+            message = encode_binary_message(message)
+        if self._publishing_history is not None:
+            for channel, message in self._publishing_history.publish([(channel, message)]):
+                self.broker.publish(message, channel)
+        else:
+            self.broker.publish(message, channel)
 
-    @async
-    def _listen(self):
-        """Listen in a thread for new messages in Redis, and send them to registered web-sockets.
-        See: https://github.com/andymccurdy/redis-py#publish--subscribe
+    def publish_many(self, messages):
+        """Publish several messages at once through the broker, e.g. a batch of notifications;
+        the Redis broker sends them in pipelines instead of one round trip per message.
+
+        Args:
+            messages (dict|iterable): {channel: message} or (channel, message) pairs; an
+                iterable is consumed lazily, and ValueError is raised when a message on a
+                reserved channel is reached (see `publish_message`)
         """
-        self.pubsub.psubscribe(self.REDIS_CHANNEL_PREFIX + '*')  # listen to all channels
-        channel_prefix_len = len(self.REDIS_CHANNEL_PREFIX)
-        while True:
-            message = self.pubsub.get_message() if self.pubsub.subscribed else None
-            if not message:
-                gevent.sleep(0.05)  # be nice to the system
+        if isinstance(messages, dict):
+            messages = messages.iteritems()
+        if self.presence is not None:
+            messages = self._check_published_channels(messages)
+        messages = ((channel, encode_binary_message(message)
+                     if isinstance(message, BINARY_TYPES) else message)
+                    for channel, message in messages)
+        metrics = self.metrics
+        if metrics.enabled:
+            messages = self._count_published(messages)
+        if self._publishing_history is not None:
+            messages = self._publishing_history.publish(messages)
+        self.broker.publish_many(messages)
+
+    def _check_published_channel(self, channel):
+        if self.presence is not None and channel == Presence.CHANNEL:
+            raise ValueError('The channel `%s` is reserved' % channel)
+
+    def _check_published_channels(self, messages):
+        for channel, message in messages:
+            self._check_published_channel(channel)
+            yield channel, message
+
+    def _count_published(self, messages):
+        for channel, message in messages:
+            self.metrics.increment('websocket_messages_published_total')
+            yield channel, message
+
+    def _deliver_messages(self, messages):
+        """Send messages received by the broker to websockets, in the order they were received,
+        recording the time since they were received till they were queued to all the websockets.
+
+        Args:
+            messages (list): (channel, message) pairs received at once
+        """
+        metrics = self.metrics
+        presence = self.presence
+        if not metrics.enabled:
+            for channel, message in messages:
+                if presence is not None and channel == presence.CHANNEL:
+                    presence.receive(message)
+                else:
+                    self._send_message(channel, message)
+            return
+        received_at = time.time()
+        metrics.increment('websocket_messages_delivered_total', len(messages))
+        for channel, message in messages:
+            if presence is not None and channel == presence.CHANNEL:
+                presence.receive(message)
                 continue
-            channel = message['channel'][channel_prefix_len:]
-            logger.debug(u'Received a message on channel `%s`: %s', channel, message)
-            self._send_message(channel, message['data'])
+            started_at = time.time()
+            metrics.increment('websocket_frames_sent_total', self._send_message(channel, message))
+            finished_at = time.time()
+            metrics.observe('websocket_fanout_seconds', finished_at - started_at)
+            metrics.observe('websocket_delivery_latency_seconds', finished_at - received_at)
 
-    @async
     def _send_message(self, channel, message):
-        """Asynchronously send a message to websockets handled by this worker on the given channel.
+        """Send a message to websockets handled by this worker on the given channel.
+
+        Returns:
+            int: number of websockets the message was sent to
         """
         only_subchannels = channel.endswith('/')
-        if only_subchannels:
-            logger.info(u'Sending message to clients on sub-channels of `%s`: %s',
-                        channel, message)
+        if logger.isEnabledFor(logging.DEBUG):
+            if only_subchannels:
+                logger.debug(u'Sending message to clients on sub-channels of `%s`: %r',
+                             channel, message)
+            else:
+                logger.debug(u'Sending message to clients on channel `%s`: %r', channel, message)
+        channel_sockets = subchannel = self._find_channel_sockets(channel)
+        if subchannel is None:
+            if not self.prefix_subscription_count:
+                return 0  # no websockets on the channel
+            channel_sockets = self.channel_sockets.find(
+                (name for name in channel.split('/') if name), closest=True)
+
+        message_id = None
+        history = self.history
+        if history is not None and history.ids_published:  # strip the id before the pipeline
+            message_id, message = history.add(subchannel, message, only_subchannels)
+        accept = None
+        if self.pipeline is not None:
+            try:
+                message, accept = self.pipeline.process(channel, message)
+            except Exception:
+                logger.exception(u'The pipeline failed on a message on channel `%s`', channel)
+                self.metrics.increment('websocket_pipeline_errors_total')
+                return 0
+            if message is None:
+                self.metrics.increment('websocket_messages_dropped_by_pipeline_total')
+                return 0
+        if history is not None and not history.ids_published:  # the transformed message
+            message_id, message = history.add(subchannel, message, only_subchannels)
+        frames = self._encode_frames(channel, message, message_id)
+        count = 0
+        if subchannel is not None:
+            if only_subchannels:
+                count = self._send_message_subchannels(frames, channel_sockets, accept)
+            else:
+                count = self._send_message_channel(frames, channel_sockets, accept)
+                channel_sockets = channel_sockets.parent
+        if self.prefix_subscription_count:
+            # subscribed to the sub-channels of the closest existing ancestor or to those above
+            count += self._send_message_prefixes(frames, channel_sockets, accept)
+        return count
+
+    def _send_presence(self, channel, count):
+        """Send the websockets on a channel the number of websockets on it, when it changes.
+        """
+        if channel.endswith('/'):
+            return  # a number of websockets on sub-channels
+        channel_sockets = self._find_channel_sockets(channel)
+        if channel_sockets is not None and channel_sockets.websockets:
+            self._send_message_channel(self._encode_frames(
+                channel, json.dumps({'presence': count}), None), channel_sockets)
+
+    def _find_channel_sockets(self, channel):
+        """Get the ChannelSockets node of a channel, or None if it doesn't exist. Nodes are cached
+        by the channel names they are looked up by, so a busy channel is found with one dict
+        lookup instead of splitting its name and descending the tree. A cached node which has
+        been removed from the tree is looked up again.
+        """
+        cache = self._channel_cache
+        channel_sockets = cache.get(channel)
+        if channel_sockets is not None and channel_sockets.parent is not None:
+            return channel_sockets
+        channel_sockets = self.channel_sockets.find(name for name in channel.split('/') if name)
+        if channel_sockets is None or channel_sockets.parent is None:  # missing or the root
+            cache.pop(channel, None)
+        elif self.channel_cache_size:
+            if len(cache) >= self.channel_cache_size:
+                cache.popitem()  # evict an arbitrary node
+            cache[channel] = channel_sockets
+        return channel_sockets
+
+    def _encode_frames(self, channel, message, message_id):
+        """Return the frames of a message for each `frame_type` of the connections: plain and
+        compressed, without and with the message id, and tagged with the channel for multiplexed
+        connections. The same frames are written to all the websockets. Only the frames of the
+        types some registered connections are of are encoded, the others are None.
+        """
+        payload = decode_binary_message(message)
+        if payload is not None:
+            return self._encode_binary_frames(channel, payload, message_id)
+        counts = self._frame_type_counts
+        compress = self._compresses(message)
+        if message_id is None:
+            frames = list(self._encode_message_frames(
+                message, compress, counts[0] + counts[2], counts[1] + counts[3])) * 2
         else:
-            logger.info(u'Sending message to clients on channel `%s`: %s', channel, message)
-        channel_sockets = self.channel_sockets
-        for channel in channel.split('/'):
-            if channel:
-                channel_sockets = channel_sockets[channel]
+            frames = list(self._encode_message_frames(message, compress, counts[0], counts[1]))
+            if counts[2] or counts[3]:
+                frames.extend(self._encode_message_frames(
+                    encode_history_message(message_id, message), compress, counts[2],
+                    counts[3]))
+            else:
+                frames.extend((None, None))
+        if counts[4] or counts[5]:
+            frames.extend(self._encode_message_frames(
+                encode_multiplexed_message(channel, message, message_id), compress, counts[4],
+                counts[5]))
+        return frames
 
-        if only_subchannels:
-            self._send_message_subchannels(message, channel_sockets)
+    def _encode_binary_frames(self, channel, payload, message_id):
+        """Return the frames of a binary message for each `frame_type` of the connections, see
+        `_encode_frames`. The clients sent message ids or channels get the message in an
+        envelope if `envelope` is set, otherwise just the payload.
+        """
+        counts = self._frame_type_counts
+        compress = self._compresses(payload)
+        if self.envelope is None:
+            return list(self._encode_message_frames(
+                payload, compress, counts[0] + counts[2] + counts[4],
+                counts[1] + counts[3] + counts[5], binary=True)) * 3
+        if message_id is None:
+            frames = list(self._encode_message_frames(
+                payload, compress, counts[0] + counts[2], counts[1] + counts[3],
+                binary=True)) * 2
+            envelope_counts = counts[4], counts[5]
         else:
-            self._send_message_channel(message, channel_sockets)
+            frames = list(self._encode_message_frames(
+                payload, compress, counts[0], counts[1], binary=True))
+            envelope_counts = counts[2] + counts[4], counts[3] + counts[5]
+        envelope_frames = None, None
+        if envelope_counts[0] or envelope_counts[1]:
+            envelope_frames = self._encode_message_frames(
+                encode_envelope(channel, payload, message_id), compress, *envelope_counts,
+                binary=True)
+        if message_id is not None:
+            frames.extend(envelope_frames)
+        frames.extend(envelope_frames)
+        return frames
+
+    def _compresses(self, message):
+        """Return whether a message is to be compressed: it is large enough and some registered
+        connections are sent compressed frames.
+        """
+        counts = self._frame_type_counts
+        if (self.deflate and len(message) >= self.deflate_min_size and
+                (counts[1] or counts[3] or counts[5])):
+            self.metrics.increment('websocket_messages_compressed_total')
+            return True
+        return False
+
+    def _encode_message_frames(self, message, compress, plain_count, deflate_count,
+                               binary=False):
+        """Return the plain and compressed frames of a message, for the given numbers of the
+        connections sent each of them; a frame no connection is sent is None.
+        """
+        if compress and deflate_count:
+            return (encode_frame(message, binary) if plain_count else None,
+                    encode_frame(message, binary, deflate=True))
+        if plain_count or deflate_count:
+            frame = encode_frame(message, binary)
+            return frame, frame
+        return None, None
+
+    def _send_message_channel(self, frames, channel_sockets, accept=None):
+        """Send the given frames only to websockets of the given channel, each the frame of its
+        type. The frames are only queued, so this doesn't wait for slow clients. Closed
+        connections are unregistered by their handlers.
+
+        Args:
+            accept (callable): if given, selects the websockets by their attributes, see
+                `MessagePipeline`
+
+        Returns:
+            int: number of websockets the frames were sent to
+        """
+        return self._send_frames(frames, channel_sockets.websockets, accept)
+
+    def _send_message_subchannels(self, frames, channel_sockets, accept=None):
+        """Send the given frames to weboskets only of subchannels of the given channel. They are
+        taken from the index of the channel, the subtree is not walked.
+
+        Returns:
+            int: number of websockets the frames were sent to
+        """
+        return self._send_frames(frames, channel_sockets.descendant_websockets, accept)
+
+    def _send_message_prefixes(self, frames, channel_sockets, accept=None):
+        """Send the given frames to the subscriptions to all the sub-channels of the given
+        channel and of its ancestors.
+
+        Returns:
+            int: number of subscriptions the frames were sent to
+        """
+        count = 0
+        while channel_sockets is not None:
+            count += self._send_frames(frames, channel_sockets.prefix_websockets, accept)
+            channel_sockets = channel_sockets.parent
+        return count
+
+    def _send_frames(self, frames, connections, accept=None):
+        """Send the given frames to the connections accepted by `accept`, or to all of them.
+        A connection on which `accept` fails isn't sent the frames.
 
-    def _send_message_channel(self, message, channel_sockets):
-        """Send the given meesage only to websockets of the given channel.
+        Returns:
+            int: number of connections the frames were sent to
         """
-        websockets = channel_sockets.websockets
-        for websocket in tuple(websockets):  # changes during iteration
-            # import random
-            # if not random.randint(0, 10):
-            #     websocket.close()
-            #     continue
+        if accept is None:
+            for connection in connections:
+                connection.send_frame(frames[connection.frame_type])
+            return len(connections)
+        count = error_count = 0
+        for connection in connections:
             try:
-                websocket.send(message)
-            except geventwebsocket.WebSocketError:
-                # discard invalid connection
-                websockets.remove(websocket)
+                accepted = accept(connection.attributes)
+            except Exception:
+                if not error_count:  # logged once per message
+                    logger.exception('A predicate of the pipeline failed')
+                error_count += 1
+                continue
+            if accepted:
+                connection.send_frame(frames[connection.frame_type])
+                count += 1
+        if error_count:
+            self.metrics.increment('websocket_pipeline_errors_total', error_count)
+        return count
+
+    def _update_gauges(self):
+        """Calculate the gauges, which are needed only when the metrics are exported or shared:
+        connected websockets (in total and per top level channel), their outbound queues and the
+        values reported by the broker.
+        """
+        metrics = self.metrics
+        metrics.gauges.clear()
+        metrics.set_gauge('websocket_connections', len(self.connections))
+        metrics.set_gauge('websocket_admitted_connections', self.admission.connection_count)
+        metrics.set_gauge('websocket_draining', int(self.draining))
+        if self.presence is not None:
+            metrics.set_gauge('websocket_presence_workers', len(self.presence.workers))
+        if self.heartbeats is not None:
+            metrics.set_gauge('websocket_heartbeat_timers', len(self.heartbeats.wheel))
+        metrics.set_gauge('websocket_send_queue_size',
+                          sum(len(connection.queue) for connection in self.connections))
+        for channel_sockets in self.channel_sockets:
+            metrics.set_gauge(
+                'websocket_channel_connections',
+                len(channel_sockets.websockets) + len(channel_sockets.prefix_websockets) +
+                len(channel_sockets.descendant_websockets),
+                channel=channel_sockets.key)
+        stats = [('websocket_broker', {}, self.broker.stats())]
+        while stats:
+            prefix, labels, values = stats.pop()
+            for name, value in values.iteritems():
+                if isinstance(value, dict):
+                    stats.append((prefix + '_' + name, labels, value))
+                elif isinstance(value, list):  # (labels, values) pairs, see `Broker.stats`
+                    stats.extend((prefix + '_' + name, dict(labels, **item_labels), item_values)
+                                 for item_labels, item_values in value)
+                else:
+                    metrics.set_gauge(prefix + '_' + name, value, **labels)
+
+    def export_metrics(self):
+        """Return the metrics in the Prometheus text format.
+        """
+        return self.metrics.export()  # the gauges are set by `_update_gauges`
 
-    def _send_message_subchannels(self, message, channel_sockets):
-        """Send the given meesage to weboskets only of subchannels of the given channel.
+    def stats(self):
+        """Return the current values of the metrics of this worker.
         """
-        for channel_sockets in channel_sockets:
-            self._send_message_channel(message, channel_sockets)
-            self._send_message_subchannels(message, channel_sockets)
+        self._update_gauges()
+        return self.metrics.snapshot()
@@ -8,6 +8,7 @@ import os
 
 from ws4py.server.geventserver import WebSocketWSGIApplication, WSGIServer, WebSocketWSGIHandler
 import ws4py.websocket
+from ws4py.messaging import TextMessage
 
 import gevent.queue
 import redis
@@ -65,16 +66,8 @@ class WebSocket(ws4py.websocket.WebSocket):
     def received_message(self, message):
         self.app.on_message_received(message, self.channel)
 
-    # TODO: call self.app.on_websocket_closed to expunge websocket from channel_sockets
-    # def closed(self, code, reason="A client left the room without a proper explanation."):
-    #     app = self.environ.pop('.app')
-    #     if self in app.clients:
-    #         app.clients.remove(self)
-    #         for client in app.clients:
-    #             try:
-    #                 client.send(reason)
-    #             except:
-    #                 pass
+    def closed(self, code, reason=None):
+        self.app.unregister_websocket(self, self.channel)
 
 
 BASE_DIR = os.path.abspath(os.path.dirname(__name__) + '/..')
@@ -84,11 +77,13 @@ TEMPLATE_DIR = os.path.join(BASE_DIR, 'templates')
 class WebSocketChannelApp(WebSocketWSGIApplication):
 
     REDIS_CHANNEL_PREFIX = 'websocket:'
+    CHANNEL_CACHE_SIZE = 10000  # maximum number of channels in `_channel_cache`
 
     def __init__(self, redis_url, protocols=None, extensions=None, handler_cls=WebSocket):
         super(WebSocketChannelApp, self).__init__(protocols, extensions, handler_cls)
         self.redis_client = redis.from_url(redis_url)
         self.channel_sockets = ChannelSockets('')
+        self._channel_cache = {}  # channel name -> ChannelSockets, see `get_channel_sockets`
         self.jinja_env = Environment(loader=FileSystemLoader(TEMPLATE_DIR), autoescape=True)
         self.published_message_queue = gevent.queue.Queue()
         self.consume_published_messages()
@@ -135,6 +130,10 @@ class WebSocketChannelApp(WebSocketWSGIApplication):
 
     def __call__(self, environ, start_response):
         environ['ws4py.websocket'] = None  # to be removed -- in the newer ws4py it's not needed
+        path = environ.get('PATH_INFO', '')
+        if path.startswith('/ws/') and path[4:5] not in ('', '/'):
+            # the `ws` rule, matched without binding the URL map to every websocket request
+            return self.view_ws(environ, path[4:])(environ, start_response)
         adapter = self.url_map.bind_to_environ(environ)
         try:
             endpoint, view_args = adapter.match()
@@ -153,6 +152,14 @@ class WebSocketChannelApp(WebSocketWSGIApplication):
             sockets = sockets[channel]
         sockets.websockets.add(websocket)
 
+    def unregister_websocket(self, websocket, channel):
+        """Callback to unregister a closed websocket, so it's no longer sent messages.
+        """
+        sockets = self.channel_sockets
+        for channel in channel.split('/'):
+            sockets = sockets[channel]
+        sockets.websockets.discard(websocket)
+
     def on_message_received(self, message, channel):
         """Callback called when a new message from a client via websocket arrives.
         The default implementation publishes the message. You can subclass this to apply custom
@@ -197,32 +204,47 @@ class WebSocketChannelApp(WebSocketWSGIApplication):
                         channel, message)
         else:
             logger.info(u'Sending message to clients on channel `%s`: %s', channel, message)
-        channel_sockets = self.channel_sockets
-        for channel in channel.split('/'):
-            if channel:
-                channel_sockets = channel_sockets[channel]
+        channel_sockets = self.get_channel_sockets(channel)
 
+        # server frames are not masked, so the same frame is written to all the websockets
+        frame = TextMessage(message).single()
         if only_subchannels:
-            self._send_message_subchannels(message, channel_sockets)
+            self._send_message_subchannels(frame, channel_sockets)
         else:
-            self._send_message_channel(message, channel_sockets)
+            self._send_message_channel(frame, channel_sockets)
 
-    def _send_message_channel(self, message, channel_sockets):
-        """Send the given meesage to websockets only of the given channel.
+    def get_channel_sockets(self, channel):
+        """Get the ChannelSockets node of a channel, creating it if needed. Nodes are cached by
+        channel name, so a busy channel is found with one dict lookup instead of splitting its
+        name and descending the tree.
+        """
+        channel_sockets = self._channel_cache.get(channel)
+        if channel_sockets is None:
+            channel_sockets = self.channel_sockets
+            for name in channel.split('/'):
+                if name:
+                    channel_sockets = channel_sockets[name]
+            if len(self._channel_cache) >= self.CHANNEL_CACHE_SIZE:
+                self._channel_cache.popitem()  # evict an arbitrary node
+            self._channel_cache[channel] = channel_sockets
+        return channel_sockets
+
+    def _send_message_channel(self, frame, channel_sockets):
+        """Send the given frame to websockets only of the given channel.
         """
         websockets = channel_sockets.websockets
         for websocket in tuple(websockets):  # changes during iteration
             if websocket.terminated:
                 websockets.remove(websocket)
             else:
-                websocket.send(message)
+                websocket._write(frame)
 
-    def _send_message_subchannels(self, message, channel_sockets):
-        """Send the given meesage to weboskets only of subchannels of the given channel.
+    def _send_message_subchannels(self, frame, channel_sockets):
+        """Send the given frame to weboskets only of subchannels of the given channel.
         """
         for channel_sockets in channel_sockets:
-            self._send_message_channel(message, channel_sockets)
-            self._send_message_subchannels(message, channel_sockets)
+            self._send_message_channel(frame, channel_sockets)
+            self._send_message_subchannels(frame, channel_sockets)
 
 
 try: